@@ -0,0 +1,511 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+
+import chatstore
+
+# Load and latency benchmark for the chat data layer in chatstore.py.
+# Seeds a scratch chat.db with a synthetic history, then runs simulated sessions that call the
+# same data functions as the app on its refresh cadence and reports per-operation latency and how
+# often sessions rerun. --mode live follows the page's live-update fragment (the default);
+# --mode poll reloads every page on a fixed interval, as the page did before live updates.
+#
+#   python bench_chat.py --messages 200000 --users 200 --sessions 100 --duration 60 --output bench.json
+
+WORDS = (
+    "hello world meeting lunch coffee deploy release review merge branch build test bug fix "
+    "ticket sprint design update schedule weekend holiday report budget invoice customer server "
+    "database query index cache latency network backup restore ok thanks yes no maybe later"
+).split()
+
+SEED_BATCH_SIZE = 50000
+# Reruns not caused by the session's own clicks
+IDLE_RERUN_REASONS = ("event", "presence", "poll", "refresh")
+
+# --- SYNTHETIC HISTORY ---
+def user_names(count):
+    return [f"user{i:04d}" for i in range(count)]
+
+def random_text(rng, min_words=3, max_words=20):
+    return " ".join(rng.choices(WORDS, k=rng.randint(min_words, max_words)))
+
+def random_id(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+def write_seed_blobs(conn, rng, count):
+    blobs = []
+    for i in range(count):
+        payload = rng.randbytes(rng.randint(4 * 1024, 64 * 1024))
+        tmp_path = os.path.join(chatstore.UPLOAD_FOLDER, f"seed-{i}.bin")
+        os.makedirs(chatstore.UPLOAD_FOLDER, exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        digest = hashlib.sha256(payload).hexdigest()
+        path = chatstore.blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        conn.execute("INSERT INTO upload_blobs (hash, size, refcount) VALUES (?, ?, 0)", (digest, len(payload)))
+        blobs.append((chatstore.BLOB_REF_PREFIX + digest, len(payload), f"report-{i}.pdf"))
+    return blobs
+
+# Bulk-loads messages, likes and uploads with all derived tables (counts, search index,
+# like_count, blob refcounts) filled in as the app's own writes would leave them
+def seed_history(args, users):
+    rng = random.Random(args.seed)
+    conn = sqlite3.connect(chatstore.DB_NAME, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("BEGIN")
+    pin_hash = chatstore.hash_pin(args.pin)
+    conn.executemany("INSERT INTO user_pins (username, pin_hash) VALUES (?, ?)", [(u, pin_hash) for u in users])
+    blobs = write_seed_blobs(conn, rng, args.blobs) if args.attachment_ratio > 0 else []
+    blob_refs = defaultdict(int)
+
+    now_ms = int(time.time() * 1000)
+    start_ms = now_ms - args.history_days * 86400 * 1000
+    step_ms = max(1, (now_ms - start_ms) // max(1, args.messages))
+    recent = defaultdict(lambda: deque(maxlen=50))
+    counts = defaultdict(int)
+    messages, likes = [], []
+
+    def flush():
+        conn.executemany(f"""
+            INSERT INTO messages ({chatstore.MESSAGE_COLUMNS}, conversation_id, ts)
+            VALUES ({", ".join("?" * (len(chatstore.MESSAGE_COLUMNS.split(", ")) + 2))})
+        """, messages)
+        conn.executemany("INSERT INTO message_likes (message_id, username) VALUES (?, ?)", likes)
+        messages.clear()
+        likes.clear()
+
+    for i in range(args.messages):
+        sender = rng.choice(users)
+        recipient = None
+        if len(users) > 1 and rng.random() < args.private_ratio:
+            recipient = rng.choice([u for u in rng.sample(users, 2) if u != sender])
+        conversation_id = chatstore.conversation_key(sender, recipient)
+        ts = start_ms + i * step_ms
+        timestamp = datetime.fromtimestamp(ts / 1000, timezone.utc).isoformat()
+        msg_id = random_id(rng)
+        reply_to = None
+        if recent[conversation_id] and rng.random() < args.reply_ratio:
+            reply_to = rng.choice(recent[conversation_id])
+
+        msg_type, content, file_path, file_name, file_size, mime_type = "text", random_text(rng), None, None, None, None
+        if blobs and rng.random() < args.attachment_ratio:
+            file_path, file_size, file_name = rng.choice(blobs)
+            msg_type, content, mime_type = "file", None, chatstore.guess_mime_type(file_name)
+            blob_refs[file_path] += 1
+
+        likers = []
+        if rng.random() < args.like_ratio:
+            likers = rng.sample(users, min(len(users), rng.randint(1, 3)))
+            likes.extend((msg_id, u) for u in likers)
+
+        messages.append((
+            msg_id, sender, timestamp, msg_type, content, file_path, recipient, reply_to, len(likers),
+            file_name, file_size, mime_type, 0, len(likers), conversation_id, ts,
+        ))
+        recent[conversation_id].append(msg_id)
+        counts[conversation_id] += 1
+        if len(messages) >= SEED_BATCH_SIZE:
+            flush()
+    flush()
+
+    conn.executemany(
+        "INSERT INTO conversation_counts (conversation_id, total, member_a, member_b) VALUES (?, ?, ?, ?)",
+        [
+            (conversation_id, total, *(json.loads(conversation_id) if conversation_id != "global" else (None, None)))
+            for conversation_id, total in counts.items()
+        ],
+    )
+    conn.executemany(
+        "UPDATE upload_blobs SET refcount = ? WHERE hash = ?",
+        [(n, ref[len(chatstore.BLOB_REF_PREFIX):]) for ref, n in blob_refs.items()],
+    )
+    # Search index rows reuse the message rowid, the same link index_message_content records
+    conn.create_function("search_scope", 1, chatstore.search_scope, deterministic=True)
+    conn.execute("""
+        INSERT INTO messages_fts (rowid, content, scope, message_id, conversation_id)
+        SELECT rowid, content, search_scope(conversation_id), id, conversation_id
+        FROM messages WHERE content IS NOT NULL
+    """)
+    conn.execute("UPDATE messages SET search_rowid = rowid WHERE content IS NOT NULL")
+    conn.execute("COMMIT")
+    conn.execute("ANALYZE")
+    conn.close()
+
+# --- SIMULATED SESSIONS ---
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.reruns = defaultdict(int)
+
+    def timed(self, op, fn, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            self.errors[op] += 1
+            return None
+        finally:
+            self.samples[op].append(time.perf_counter() - started)
+
+    def rerun(self, reason):
+        self.reruns[reason] += 1
+
+# A click: send, like, search or page back, on the messages currently shown
+def user_action(args, user, chat_with, messages, recorder, rng):
+    if rng.random() < args.send_rate:
+        reply_to = rng.choice(messages)[0] if messages and rng.random() < args.reply_ratio else None
+        if rng.random() < args.attachment_ratio:
+            recorder.timed(
+                "save_message", chatstore.save_message, user, "file", file_name="notes.txt",
+                file_bytes=rng.randbytes(rng.randint(1024, 16 * 1024)), recipient=chat_with, reply_to=reply_to,
+            )
+        else:
+            recorder.timed(
+                "save_message", chatstore.save_message, user, "text", content=random_text(rng),
+                recipient=chat_with, reply_to=reply_to,
+            )
+    if messages and rng.random() < args.like_rate:
+        msg_id = rng.choice(messages)[0]
+        if recorder.timed("user_liked_message", chatstore.user_liked_message, user, msg_id):
+            recorder.timed("remove_like", chatstore.remove_like, user, msg_id)
+        else:
+            recorder.timed("add_like", chatstore.add_like, user, msg_id)
+    if rng.random() < args.search_rate:
+        recorder.timed(
+            "search_messages", chatstore.search_messages, user, chat_with,
+            " ".join(rng.sample(WORDS, rng.randint(1, 2))), page_size=args.page_size,
+        )
+    if messages and rng.random() < args.page_back_rate:
+        recorder.timed(
+            "get_messages_older", chatstore.get_messages, user, chat_with,
+            before=messages[0][0], page_size=args.page_size,
+        )
+
+# Page state a live session keeps between reruns, like the app's chat_view and live subscription
+class LiveSession:
+    def __init__(self, args, user, chat_with, recorder):
+        self.args = args
+        self.user = user
+        self.chat_with = chat_with
+        self.conversation_id = chatstore.conversation_key(user, chat_with)
+        self.recorder = recorder
+        self.subscription = None
+        self.view = None
+        self.seen_seq = 0
+        self.last_run = self.last_poll = time.monotonic()
+
+    def load_view(self):
+        timed = self.recorder.timed
+        seq = timed("get_change_seq", chatstore.get_change_seq)
+        page = timed("get_messages", chatstore.get_messages, self.user, self.chat_with, page_size=self.args.page_size)
+        messages, total_count = (page[0], page[1]) if page else ([], 0)
+        timed("get_likes_for_messages", chatstore.get_likes_for_messages,
+              [m[0] for m in messages if m[8]], self.conversation_id)
+        timed("get_archived_message_ids", chatstore.get_archived_message_ids, [m[0] for m in messages])
+        self.view = {"seq": seq or 0, "messages": messages, "total_count": total_count}
+
+    # The app's apply_chat_changes: refetch changed rows and append new ones to the newest page
+    def apply_changes(self, changes):
+        timed = self.recorder.timed
+        page_ids = {m[0] for m in self.view["messages"]}
+        inserted = {message_id for _, message_id, kind in changes if kind == "insert" and message_id not in page_ids}
+        changed = {message_id for _, message_id, kind in changes if kind != "insert"}
+        stale = {m[0] for m in self.view["messages"] if m[0] in changed or m[7] in changed}
+        fetched = timed("get_messages_by_ids", chatstore.get_messages_by_ids, list(stale | inserted)) or []
+        refreshed = {row[0]: row for row in fetched}
+        messages = [refreshed.get(m[0], m) for m in self.view["messages"]]
+        messages += [row for row in fetched if row[0] in inserted]
+        timed("get_likes_for_messages", chatstore.get_likes_for_messages, [row[0] for row in fetched if row[8]])
+        self.view["messages"] = messages[-self.args.page_size:]
+        self.view["total_count"] += len(inserted)
+        self.view["seq"] = changes[-1][0]
+
+    def rerun(self, reason):
+        timed = self.recorder.timed
+        self.recorder.rerun(reason)
+        timed("update_user_last_seen", chatstore.update_user_last_seen, self.user)
+        timed("get_online_users", chatstore.get_online_users)
+        unread_counts = timed("get_unread_counts", chatstore.get_unread_counts, self.user) or {}
+
+        topics = set(unread_counts) | {
+            self.conversation_id, "global", chatstore.user_topic(self.user), chatstore.PRESENCE_TOPIC,
+        }
+        if self.subscription is None or self.subscription.topics != topics:
+            if self.subscription is not None:
+                chatstore.get_broker().unsubscribe(self.subscription)
+            self.subscription = chatstore.get_broker().subscribe(topics)
+        self.subscription.drain()
+        self.seen_seq = timed("get_change_seq", chatstore.get_change_seq) or self.seen_seq
+        self.last_run = self.last_poll = time.monotonic()
+
+        if self.view is None:
+            self.load_view()
+        else:
+            changes = timed("get_changes_since", chatstore.get_changes_since, self.view["seq"], self.conversation_id)
+            if changes is None:
+                self.load_view()
+            elif changes:
+                self.apply_changes(changes)
+        _, unread = unread_counts.get(self.conversation_id, (None, 0))
+        if unread:
+            timed("mark_conversation_read", chatstore.mark_conversation_read,
+                  self.user, self.conversation_id, self.view["total_count"])
+
+    # One run of the live_updates fragment; returns the reason for a full rerun, if any
+    def live_check(self):
+        now = time.monotonic()
+        if self.subscription.drain():
+            return "event"
+        if now - self.last_run >= self.args.presence_refresh:
+            return "presence"
+        if now - self.last_poll >= self.args.fallback_poll:
+            self.last_poll = now
+            changes = self.recorder.timed(
+                "get_changes_since", chatstore.get_changes_since, self.seen_seq, self.conversation_id
+            )
+            if changes != []:
+                return "poll"
+        return None
+
+# One browser session on the live page: reruns when the fragment finds something to show (or for the
+# periodic presence refresh) and after each of the user's clicks, which come every --action-interval
+# seconds on average.
+def run_live_session(args, user, chat_with, deadline, recorder, rng):
+    time.sleep(rng.uniform(0, args.live_check))
+    session = LiveSession(args, user, chat_with, recorder)
+    session.rerun("load")
+    next_action = time.monotonic() + rng.expovariate(1 / args.action_interval)
+    while time.monotonic() < deadline:
+        tick = time.monotonic()
+        if tick >= next_action:
+            user_action(args, user, chat_with, session.view["messages"], recorder, rng)
+            session.rerun("action")
+            next_action = time.monotonic() + rng.expovariate(1 / args.action_interval)
+        else:
+            reason = session.live_check()
+            if reason:
+                session.rerun(reason)
+        time.sleep(max(0, args.live_check - (time.monotonic() - tick)))
+    if session.subscription is not None:
+        chatstore.get_broker().unsubscribe(session.subscription)
+
+# The page before live updates: every refresh reports presence, lists online users and reloads its
+# page, and each refresh may also be a click.
+def run_polling_session(args, user, chat_with, deadline, recorder, rng):
+    time.sleep(rng.uniform(0, args.refresh_interval))
+    while time.monotonic() < deadline:
+        tick = time.monotonic()
+        recorder.rerun("refresh")
+        recorder.timed("update_user_last_seen", chatstore.update_user_last_seen, user)
+        recorder.timed("get_online_users", chatstore.get_online_users)
+        recorder.timed("get_unread_counts", chatstore.get_unread_counts, user)
+        page = recorder.timed("get_messages", chatstore.get_messages, user, chat_with, page_size=args.page_size)
+        messages = page[0] if page else []
+        recorder.timed("get_likes_for_messages", chatstore.get_likes_for_messages, [m[0] for m in messages if m[8]])
+        user_action(args, user, chat_with, messages, recorder, rng)
+        time.sleep(max(0, args.refresh_interval - (time.monotonic() - tick)))
+
+def run_sessions(args, users):
+    rng = random.Random(args.seed + 1)
+    deadline = time.monotonic() + args.duration
+    recorders, threads = [], []
+    for i in range(args.sessions):
+        user = users[i % len(users)]
+        chat_with = None
+        if len(users) > 1 and rng.random() < args.private_ratio:
+            chat_with = rng.choice([u for u in users if u != user])
+        recorder = Recorder()
+        thread = threading.Thread(
+            target=run_live_session if args.mode == "live" else run_polling_session,
+            args=(args, user, chat_with, deadline, recorder, random.Random(rng.getrandbits(64))),
+            name=f"session-{i}",
+            daemon=True,
+        )
+        recorders.append(recorder)
+        threads.append(thread)
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    samples, errors, reruns = defaultdict(list), defaultdict(int), defaultdict(int)
+    for recorder in recorders:
+        for op, values in recorder.samples.items():
+            samples[op].extend(values)
+        for op, count in recorder.errors.items():
+            errors[op] += count
+        for reason, count in recorder.reruns.items():
+            reruns[reason] += count
+    return samples, errors, reruns, elapsed
+
+# --- REPORTING ---
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile
+    return sorted_values[max(1, math.ceil(pct / 100 * len(sorted_values))) - 1]
+
+def summarize(samples, errors, elapsed):
+    results = {}
+    for op in sorted(samples):
+        values = sorted(samples[op])
+        results[op] = {
+            "count": len(values),
+            "errors": errors.get(op, 0),
+            "throughput_per_s": len(values) / elapsed if elapsed else None,
+            "mean_ms": sum(values) / len(values) * 1000,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "max_ms": values[-1] * 1000,
+        }
+    return results
+
+def summarize_reruns(reruns, sessions, elapsed):
+    session_minutes = sessions * elapsed / 60
+    results = {
+        reason: {"count": count, "per_session_minute": count / session_minutes if session_minutes else None}
+        for reason, count in sorted(reruns.items())
+    }
+    idle = sum(reruns.get(reason, 0) for reason in IDLE_RERUN_REASONS)
+    results["idle"] = {"count": idle, "per_session_minute": idle / session_minutes if session_minutes else None}
+    return results
+
+def print_report(results, elapsed, rerun_results):
+    header = f"{'operation':<24}{'count':>9}{'err':>6}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for op, r in results.items():
+        print(
+            f"{op:<24}{r['count']:>9}{r['errors']:>6}{r['throughput_per_s']:>10.1f}"
+            f"{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['max_ms']:>10.2f}"
+        )
+    print(f"\n{sum(r['count'] for r in results.values())} operations in {elapsed:.1f}s")
+
+    print(f"\n{'reruns':<24}{'count':>9}{'per session-min':>17}")
+    for reason, r in rerun_results.items():
+        print(f"{reason:<24}{r['count']:>9}{r['per_session_minute']:>17.2f}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the privatechat data layer under simulated sessions.")
+    history = parser.add_argument_group("synthetic history")
+    history.add_argument("--messages", type=int, default=100000, help="messages to seed (default: %(default)s)")
+    history.add_argument("--users", type=int, default=100, help="registered users (default: %(default)s)")
+    history.add_argument("--history-days", type=int, default=365, help="time span of the history (default: %(default)s)")
+    history.add_argument("--private-ratio", type=float, default=0.5,
+                         help="share of private messages and private-chat sessions (default: %(default)s)")
+    history.add_argument("--reply-ratio", type=float, default=0.2, help="share of replies (default: %(default)s)")
+    history.add_argument("--like-ratio", type=float, default=0.3, help="share of liked messages (default: %(default)s)")
+    history.add_argument("--attachment-ratio", type=float, default=0.05,
+                         help="share of file messages (default: %(default)s)")
+    history.add_argument("--blobs", type=int, default=16, help="distinct seeded attachments (default: %(default)s)")
+
+    load = parser.add_argument_group("load")
+    load.add_argument("--mode", choices=("live", "poll"), default="live",
+                      help="live: rerun on live updates and clicks; poll: reload on every refresh (default: %(default)s)")
+    load.add_argument("--sessions", type=int, default=50, help="concurrent simulated sessions (default: %(default)s)")
+    load.add_argument("--duration", type=float, default=30, help="seconds to run the load (default: %(default)s)")
+    load.add_argument("--page-size", type=int, default=20, help="messages per page (default: %(default)s)")
+    load.add_argument("--send-rate", type=float, default=0.1, help="chance a click sends a message (default: %(default)s)")
+    load.add_argument("--like-rate", type=float, default=0.05, help="chance a click toggles a like (default: %(default)s)")
+    load.add_argument("--search-rate", type=float, default=0.02, help="chance a click searches (default: %(default)s)")
+    load.add_argument("--page-back-rate", type=float, default=0.05,
+                      help="chance a click loads an older page (default: %(default)s)")
+
+    live = parser.add_argument_group("live mode (defaults match privatechat.py)")
+    live.add_argument("--action-interval", type=float, default=5.0,
+                      help="mean seconds between clicks of one session (default: %(default)s)")
+    live.add_argument("--live-check", type=float, default=0.5,
+                      help="seconds between runs of the live-update fragment (default: %(default)s)")
+    live.add_argument("--fallback-poll", type=float, default=10,
+                      help="seconds between change-feed polls of the fragment (default: %(default)s)")
+    live.add_argument("--presence-refresh", type=float, default=30,
+                      help="seconds after which the fragment reruns the page anyway (default: %(default)s)")
+
+    poll = parser.add_argument_group("poll mode")
+    poll.add_argument("--refresh-interval", type=float, default=5.0,
+                      help="seconds between refreshes of one session, each also a click (default: %(default)s)")
+
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default: %(default)s)")
+    parser.add_argument("--pin", default="1234", help="PIN of the seeded users (default: %(default)s)")
+    parser.add_argument("--workdir", help="directory for chat.db and uploads; kept afterwards and reused if it "
+                                          "already holds a chat.db (default: a temporary directory)")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="bench_chat-")
+    os.makedirs(workdir, exist_ok=True)
+    origin = os.getcwd()
+    os.chdir(workdir)
+    try:
+        users = user_names(args.users)
+        reused = os.path.exists(chatstore.DB_NAME)
+        chatstore.init_db()
+        seed_seconds = None
+        if not reused:
+            print(f"Seeding {args.messages} messages for {args.users} users in {workdir} ...", flush=True)
+            started = time.monotonic()
+            seed_history(args, users)
+            seed_seconds = time.monotonic() - started
+            print(f"Seeded in {seed_seconds:.1f}s", flush=True)
+        else:
+            with sqlite3.connect(chatstore.DB_NAME) as conn:
+                users = [row[0] for row in conn.execute("SELECT username FROM user_pins ORDER BY username")] or users
+            print(f"Reusing {os.path.join(workdir, chatstore.DB_NAME)}", flush=True)
+
+        print(f"Running {args.sessions} {args.mode} sessions for {args.duration:.0f}s ...", flush=True)
+        samples, errors, reruns, elapsed = run_sessions(args, users)
+        chatstore.get_presence().flush()
+        with sqlite3.connect(chatstore.DB_NAME) as conn:
+            message_rows = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    finally:
+        os.chdir(origin)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = summarize(samples, errors, elapsed)
+    rerun_results = summarize_reruns(reruns, args.sessions, elapsed)
+    print()
+    print_report(results, elapsed, rerun_results)
+    if args.output:
+        report = {
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+            "config": vars(args),
+            "environment": {
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+            },
+            "seed_seconds": seed_seconds,
+            "message_rows": message_rows,
+            "elapsed_seconds": elapsed,
+            "results": results,
+            "reruns": rerun_results,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
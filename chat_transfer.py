@@ -0,0 +1,418 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from contextlib import nullcontext
+from datetime import datetime, timezone
+
+import chatstore
+
+# Bulk export and import of chat history for backups and moves between hosts.
+#
+#   python chat_transfer.py export backup/ [--conversation global --conversation alice,bob] [--since 2024-01-01]
+#   python chat_transfer.py import backup/
+#
+# An export directory holds history.ndjson (a header line, then user, message and like records)
+# and blobs/, one file per attachment named by its SHA-256. Records are streamed in batches, so
+# memory use does not grow with history size. Imports commit in batches, skip messages and likes
+# that already exist, and record how far they got, so an interrupted import can simply be rerun.
+
+EXPORT_FORMAT = "privatechat-export"
+EXPORT_VERSION = 1
+HISTORY_FILE = "history.ndjson"
+BLOBS_DIR = "blobs"
+EXPORT_BATCH_SIZE = 1000
+IMPORT_BATCH_SIZE = 1000
+COPY_CHUNK_SIZE = 1024 * 1024
+END_OF_TIME_MS = 253402300799999  # 9999-12-31T23:59:59.999Z, the default --until
+
+EXPORT_COLUMNS = (
+    "id, username, recipient, timestamp, ts, type, content, file_path, reply_to, "
+    "file_name, file_size, mime_type, conversation_id"
+)
+
+# --- ATTACHMENTS ---
+def export_blob_path(export_dir, digest):
+    return os.path.join(export_dir, BLOBS_DIR, digest[:2], digest)
+
+def copy_file(source, dest):
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    with open(source, "rb") as src, open(tmp, "wb") as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+    os.replace(tmp, dest)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(COPY_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Copies a message's attachment into the export (once per content) and returns its hash, or None
+# when the message has none or its file is gone. Files from before the blob store are hashed here.
+def export_attachment(export_dir, file_path):
+    if not file_path:
+        return None
+    if file_path.startswith(chatstore.BLOB_REF_PREFIX):
+        digest = file_path[len(chatstore.BLOB_REF_PREFIX):]
+        source = chatstore.blob_path(digest)
+    else:
+        source = file_path
+        if not os.path.exists(source):
+            return None
+        digest = file_sha256(source)
+    dest = export_blob_path(export_dir, digest)
+    if not os.path.exists(dest):
+        if not os.path.exists(source):
+            return None
+        copy_file(source, dest)
+    return digest
+
+# --- EXPORT ---
+def parse_conversation(value):
+    if value == "global":
+        return "global"
+    members = [name.strip() for name in value.split(",") if name.strip()]
+    if len(members) != 2:
+        raise SystemExit(f"--conversation: expected 'global' or 'user1,user2', got {value!r}")
+    return chatstore.conversation_key(*members)
+
+def parse_time_ms(value):
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+# Messages of one database (main or an attached archive) in batches, by rowid so a full export
+# is a single pass; with conversation filters each conversation is walked along its own index
+def iter_message_batches(conn, schema, conversation_ids, since_ms, until_ms):
+    time_sql = " AND ts >= ? AND ts < ?"
+    if conversation_ids is None:
+        last_rowid = 0
+        while True:
+            rows = conn.execute(f"""
+                SELECT rowid, {EXPORT_COLUMNS} FROM {schema}.messages
+                WHERE rowid > ?{time_sql}
+                ORDER BY rowid LIMIT ?
+            """, (last_rowid, since_ms, until_ms, EXPORT_BATCH_SIZE)).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            yield [row[1:] for row in rows]
+        return
+    for conversation_id in conversation_ids:
+        last_key = (since_ms - 1, "")
+        while True:
+            rows = conn.execute(f"""
+                SELECT {EXPORT_COLUMNS} FROM {schema}.messages
+                WHERE conversation_id = ? AND (ts, id) > (?, ?){time_sql}
+                ORDER BY ts, id LIMIT ?
+            """, (conversation_id, *last_key, since_ms, until_ms, EXPORT_BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+            last_key = (rows[-1][4], rows[-1][0])
+            yield rows
+
+def message_record(export_dir, row):
+    (msg_id, username, recipient, timestamp, ts, msg_type, content, file_path, reply_to,
+     file_name, file_size, mime_type, conversation_id) = row
+    return {
+        "type": "message",
+        "id": msg_id,
+        "username": username,
+        "recipient": recipient,
+        "timestamp": timestamp,
+        "ts": ts,
+        "message_type": msg_type,
+        "content": content,
+        "reply_to": reply_to,
+        "file_name": file_name,
+        "file_size": file_size,
+        "mime_type": mime_type,
+        "attachment": export_attachment(export_dir, file_path),
+        "conversation_id": conversation_id,
+    }
+
+# Yields every export record: the header, users, then messages (archives oldest first, then the
+# hot table), each batch followed by its likes
+def iter_export_records(export_dir, conversation_ids, since_ms, until_ms):
+    yield {
+        "type": "header",
+        "format": EXPORT_FORMAT,
+        "version": EXPORT_VERSION,
+        "export_id": str(uuid.uuid4()),
+        "exported_at": datetime.now(timezone.utc).isoformat(),
+        "conversations": conversation_ids,
+        "since_ms": since_ms,
+        "until_ms": until_ms,
+    }
+    with chatstore.get_db() as conn:
+        for username, pin_hash in conn.execute("SELECT username, pin_hash FROM user_pins ORDER BY username"):
+            yield {"type": "user", "username": username, "pin_hash": pin_hash}
+
+        if conversation_ids is None:
+            months = [month for (month,) in conn.execute("SELECT DISTINCT month FROM archived_ranges ORDER BY month")]
+        else:
+            placeholders = ", ".join("?" * len(conversation_ids))
+            months = [month for (month,) in conn.execute(
+                f"SELECT DISTINCT month FROM archived_ranges WHERE conversation_id IN ({placeholders}) ORDER BY month",
+                conversation_ids,
+            )]
+        months = [
+            month for month in months
+            if os.path.exists(chatstore.archive_path(month))
+            and chatstore.month_of(since_ms) <= month <= chatstore.month_of(max(since_ms, until_ms - 1))
+        ]
+
+        for month in months + [None]:
+            schema = "main" if month is None else "archive"
+            with chatstore.attached_archive(conn, month) if month else nullcontext():
+                for rows in iter_message_batches(conn, schema, conversation_ids, since_ms, until_ms):
+                    for row in rows:
+                        yield message_record(export_dir, row)
+                    placeholders = ", ".join("?" * len(rows))
+                    likes = conn.execute(
+                        f"SELECT message_id, username FROM {schema}.message_likes WHERE message_id IN ({placeholders}) "
+                        f"ORDER BY message_id, username",
+                        [row[0] for row in rows],
+                    ).fetchall()
+                    for message_id, username in likes:
+                        yield {"type": "like", "message_id": message_id, "username": username}
+
+def export_history(export_dir, conversation_ids, since_ms, until_ms):
+    os.makedirs(export_dir, exist_ok=True)
+    counts = {}
+    history_path = os.path.join(export_dir, HISTORY_FILE)
+    tmp_path = f"{history_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as out:
+        for record in iter_export_records(export_dir, conversation_ids, since_ms, until_ms):
+            out.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+            counts[record["type"]] = counts.get(record["type"], 0) + 1
+    os.replace(tmp_path, history_path)
+    return counts
+
+# --- IMPORT ---
+# (record, byte offset after it) for each line of the history file, starting at `offset`
+def iter_history(path, offset=0):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while line := f.readline():
+            if line.strip():
+                yield json.loads(line), f.tell()
+
+def read_header(path):
+    for record, end in iter_history(path):
+        if record.get("type") != "header" or record.get("format") != EXPORT_FORMAT:
+            raise SystemExit(f"{path}: not a {EXPORT_FORMAT} file")
+        if record.get("version", 0) > EXPORT_VERSION:
+            raise SystemExit(f"{path}: export version {record['version']} is newer than this tool supports")
+        return record, end
+    raise SystemExit(f"{path}: empty export")
+
+def get_import_offset(export_id):
+    with chatstore.get_db() as conn:
+        row = conn.execute("SELECT offset FROM import_progress WHERE export_id = ?", (export_id,)).fetchone()
+    return row[0] if row else None
+
+# Copies attachments the blob store does not have yet into its temp folder, outside the write
+# transaction; the batch write then moves them into place (see chatstore.commit_upload)
+def stage_attachments(export_dir, messages):
+    staged = {}
+    tmp_dir = os.path.join(chatstore.UPLOAD_FOLDER, "tmp")
+    for record in messages:
+        digest = record.get("attachment")
+        if not digest or digest in staged or os.path.exists(chatstore.blob_path(digest)):
+            continue
+        source = export_blob_path(export_dir, digest)
+        if not os.path.exists(source):
+            continue
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        os.close(fd)
+        copy_file(source, tmp_path)
+        staged[digest] = tmp_path
+    return staged
+
+# Ids of the batch's messages that the target already holds in an archive. Runs on a pooled read
+# connection before the batch's write: archives cannot be detached inside the writer's transaction.
+def find_archived_ids(messages):
+    candidates = {}  # month -> message ids
+    archived = set()
+    with chatstore.get_db() as conn:
+        months_by_conversation = {}
+        for record in messages:
+            conversation_id = chatstore.conversation_key(record["username"], record["recipient"])
+            if conversation_id not in months_by_conversation:
+                months_by_conversation[conversation_id] = set(chatstore.get_archive_months(conn, conversation_id))
+            month = chatstore.month_of(record["ts"])
+            if month in months_by_conversation[conversation_id]:
+                candidates.setdefault(month, []).append(record["id"])
+        for month, ids in sorted(candidates.items()):
+            with chatstore.attached_archive(conn, month):
+                rows = conn.execute(
+                    f"SELECT id FROM archive.messages WHERE id IN ({', '.join('?' * len(ids))})", ids
+                ).fetchall()
+            archived.update(message_id for (message_id,) in rows)
+    return archived
+
+# One transaction per batch, run on the data layer's writer thread. Only rows that were actually
+# inserted update the derived state: conversation totals, search index, blob refcounts, like counts
+# and the change feed. Returns (stats, changes); publish the changes once the batch is committed.
+def import_batch(conn, export_id, end_offset, users, messages, likes, staged, archived):
+    stats = {"users": 0, "messages": 0, "messages_skipped": 0, "likes": 0}
+    changes = []
+    for record in users:
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO user_pins (username, pin_hash) VALUES (?, ?)",
+            (record["username"], record["pin_hash"]),
+        )
+        stats["users"] += cur.rowcount
+
+    for record in messages:
+        if record["id"] in archived:
+            stats["messages_skipped"] += 1
+            continue
+        conversation_id = chatstore.conversation_key(record["username"], record["recipient"])
+        digest = record.get("attachment")
+        file_path = chatstore.BLOB_REF_PREFIX + digest if digest else None
+        cur = conn.execute("""
+            INSERT OR IGNORE INTO messages (id, username, recipient, timestamp, ts, type, content, file_path,
+                                            reply_to, file_name, file_size, mime_type, conversation_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (record["id"], record["username"], record["recipient"] or None, record["timestamp"], record["ts"],
+              record["message_type"], record["content"], file_path, record["reply_to"], record["file_name"],
+              record["file_size"], record["mime_type"], conversation_id))
+        if not cur.rowcount:
+            stats["messages_skipped"] += 1
+            continue
+        members = sorted([record["username"], record["recipient"]]) if record["recipient"] else [None, None]
+        conn.execute("""
+            INSERT INTO conversation_counts (conversation_id, total, member_a, member_b) VALUES (?, 1, ?, ?)
+            ON CONFLICT(conversation_id) DO UPDATE SET total = total + 1
+        """, (conversation_id, *members))
+        if record["content"]:
+            chatstore.index_message_content(conn, record["id"], record["content"], conversation_id)
+        if digest:
+            if digest in staged:
+                chatstore.commit_upload(conn, staged.pop(digest), digest, record["file_size"])
+            else:
+                conn.execute("""
+                    INSERT INTO upload_blobs (hash, size, refcount) VALUES (?, ?, 1)
+                    ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1
+                """, (digest, record["file_size"]))
+        changes.append(chatstore.record_change(conn, conversation_id, record["id"], "insert"))
+        stats["messages"] += 1
+
+    for record in likes:
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO message_likes (message_id, username) VALUES (?, ?)",
+            (record["message_id"], record["username"]),
+        )
+        if not cur.rowcount:
+            continue
+        updated = conn.execute(
+            "UPDATE messages SET like_count = like_count + 1, like_version = like_version + 1 WHERE id = ? "
+            "RETURNING conversation_id",
+            (record["message_id"],),
+        ).fetchone()
+        if updated:
+            changes.append(chatstore.record_change(conn, updated[0], record["message_id"], "like"))
+            stats["likes"] += 1
+        else:
+            # The message is archived here (read-only) or was not part of the import
+            conn.execute(
+                "DELETE FROM message_likes WHERE message_id = ? AND username = ?",
+                (record["message_id"], record["username"]),
+            )
+
+    conn.execute("""
+        INSERT INTO import_progress (export_id, offset, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(export_id) DO UPDATE SET offset = excluded.offset, updated_at = excluded.updated_at
+    """, (export_id, end_offset, datetime.now(timezone.utc).isoformat()))
+    return stats, changes
+
+def import_history(export_dir, batch_size=IMPORT_BATCH_SIZE, restart=False):
+    history_path = os.path.join(export_dir, HISTORY_FILE)
+    header, header_end = read_header(history_path)
+    offset = None if restart else get_import_offset(header["export_id"])
+    stats = {"users": 0, "messages": 0, "messages_skipped": 0, "likes": 0, "resumed_at": offset}
+
+    def flush(users, messages, likes, end_offset):
+        archived = find_archived_ids(messages)
+        staged = stage_attachments(export_dir, [record for record in messages if record["id"] not in archived])
+        try:
+            batch_stats, changes = chatstore.run_write(
+                import_batch, header["export_id"], end_offset, users, messages, likes, staged, archived
+            )
+        finally:
+            for tmp_path in staged.values():  # not needed after all (message already present)
+                os.remove(tmp_path)
+        # Open pages pick the imported rows up from the change feed
+        for change in changes:
+            chatstore.publish_change(change)
+        for key, value in batch_stats.items():
+            stats[key] += value
+
+    users, messages, likes = [], [], []
+    end_offset = offset or header_end
+    for record, end_offset in iter_history(history_path, offset or header_end):
+        kind = record.get("type")
+        if kind == "user":
+            users.append(record)
+        elif kind == "message":
+            messages.append(record)
+        elif kind == "like":
+            likes.append(record)
+        if len(users) + len(messages) + len(likes) >= batch_size:
+            flush(users, messages, likes, end_offset)
+            users, messages, likes = [], [], []
+            print(f"  {stats['messages']} messages imported, {stats['messages_skipped']} already present", flush=True)
+    flush(users, messages, likes, end_offset)
+    return stats
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export or import privatechat history as NDJSON with attachments.")
+    parser.add_argument("--data-dir", default=".",
+                        help="directory holding chat.db, uploads/ and archive/ (default: current directory)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="write history and attachments to a directory")
+    export.add_argument("directory", help="export directory (created if missing)")
+    export.add_argument("--conversation", action="append", metavar="global|USER1,USER2",
+                        help="only this conversation; repeat for several (default: all)")
+    export.add_argument("--since", help="only messages at or after this ISO date/time (UTC unless given)")
+    export.add_argument("--until", help="only messages before this ISO date/time (UTC unless given)")
+
+    imp = commands.add_parser("import", help="load an export directory into the database")
+    imp.add_argument("directory", help="export directory")
+    imp.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE,
+                     help="records per transaction (default: %(default)s)")
+    imp.add_argument("--restart", action="store_true",
+                     help="ignore recorded progress and scan the whole file again (still skips existing rows)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    directory = os.path.abspath(args.directory)
+    os.chdir(args.data_dir)
+    chatstore.init_db()
+
+    if args.command == "export":
+        conversation_ids = [parse_conversation(value) for value in args.conversation] if args.conversation else None
+        since_ms = parse_time_ms(args.since) if args.since else 0
+        until_ms = parse_time_ms(args.until) if args.until else END_OF_TIME_MS
+        counts = export_history(directory, conversation_ids, since_ms, until_ms)
+        print(f"Exported {counts.get('message', 0)} messages, {counts.get('like', 0)} likes and "
+              f"{counts.get('user', 0)} users to {directory}")
+    else:
+        stats = import_history(directory, args.batch_size, args.restart)
+        resumed = f" (resumed at byte {stats['resumed_at']})" if stats["resumed_at"] else ""
+        print(f"Imported {stats['messages']} messages, {stats['likes']} likes and {stats['users']} users{resumed}; "
+              f"{stats['messages_skipped']} messages were already present")
+
+if __name__ == "__main__":
+    main()
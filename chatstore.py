@@ -0,0 +1,1948 @@
+import atexit
+import functools
+import hashlib
+import hmac
+import io
+import json
+import mimetypes
+import os
+import queue
+import re
+import secrets
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import thumbnails
+
+# Persistence for the chat: schema, messages, likes, uploads, presence and PINs. Importable without
+# Streamlit by the app, background workers and command-line tools; paths are relative to the working
+# directory. Shared objects are created once per process (see process_singleton).
+
+# --- CONFIGURATION ---
+DB_NAME = "chat.db"
+UPLOAD_FOLDER = "uploads"
+
+# Uploads are stored once per unique content under UPLOAD_FOLDER/blobs and referenced as "blob:<sha256>"
+BLOB_REF_PREFIX = "blob:"
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Image previews generated in background processes; the chat shows the first size
+THUMBNAIL_SIZES = (320, 960)
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_BACKFILL_BATCH = 200
+
+# SQLite connection pool tuning
+DB_POOL_SIZE = 8
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_SIZE_KB = 16384
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_STATEMENT_CACHE_SIZE = 256
+
+# Reply previews
+REPLY_PREVIEW_CHARS = 80
+REPLY_PREVIEW_CACHE_SIZE = 2048
+
+# Search result counts stop at SEARCH_COUNT_LIMIT matches (pages past it are not reachable)
+SEARCH_COUNT_LIMIT = 1000
+
+# Logins issue a signed session token that expires after SESSION_TTL_SECONDS. Tokens are stored
+# (hashed) in SQLite, where logouts delete them, and cached in memory; a cached token is checked
+# against SQLite again after SESSION_RECHECK_SECONDS so logouts from other processes take effect
+SESSION_TTL_SECONDS = 7 * 24 * 3600
+SESSION_RECHECK_SECONDS = 60
+SESSION_CACHE_SIZE = 4096
+
+# PINs are hashed with PBKDF2-HMAC-SHA256, slow on purpose, on PIN_KDF_WORKERS background threads
+PIN_KDF_ITERATIONS = 600000
+PIN_KDF_WORKERS = 2
+
+# Change feed: how many recent changes are kept for incremental refreshes
+CHANGE_LOG_RETENTION = 10000
+CHANGE_LOG_PRUNE_EVERY = 1000
+
+# Presence is tracked in memory; last-seen times are written to SQLite in batches every
+# PRESENCE_FLUSH_SECONDS and users seen by other processes are merged in every PRESENCE_SYNC_SECONDS
+PRESENCE_FLUSH_SECONDS = 30
+PRESENCE_SYNC_SECONDS = 30
+PRESENCE_MEMORY_SECONDS = 3600
+ONLINE_TIMEOUT_SECONDS = 120
+
+# Cross-process notifications: each server process sharing the data directory binds a Unix datagram
+# socket in NOTIFY_FOLDER and forwards the changes and presence it publishes to every other socket
+# there, rescanning for peers every NOTIFY_PEER_REFRESH_SECONDS (None disables; sessions then rely on
+# polling the change feed)
+NOTIFY_FOLDER = "run"
+NOTIFY_PEER_REFRESH_SECONDS = 2
+NOTIFY_MAX_BYTES = 65536
+
+# Archival: messages older than ARCHIVE_AFTER_DAYS are moved, ARCHIVE_BATCH_SIZE at a time, into one
+# SQLite file per month under ARCHIVE_FOLDER every ARCHIVE_INTERVAL_SECONDS (None keeps everything hot)
+ARCHIVE_FOLDER = "archive"
+ARCHIVE_AFTER_DAYS = 180
+ARCHIVE_BATCH_SIZE = 200
+ARCHIVE_BATCH_PAUSE_SECONDS = 0.05
+ARCHIVE_INTERVAL_SECONDS = 3600
+
+# Group commit: the writer thread commits up to WRITE_BATCH_MAX queued writes per transaction,
+# waiting at most WRITE_BATCH_LATENCY_SECONDS for a batch to fill
+WRITE_BATCH_MAX = 64
+WRITE_BATCH_LATENCY_SECONDS = 0.005
+
+# Instrumentation: data calls and render phases are always timed in memory. Set
+# PRIVATECHAT_METRICS_FILE to keep a Prometheus text file up to date (every METRICS_EXPORT_SECONDS)
+# and PRIVATECHAT_METRICS_LOG to append one JSON line per rerun.
+METRICS_FILE = os.environ.get("PRIVATECHAT_METRICS_FILE")
+METRICS_LOG = os.environ.get("PRIVATECHAT_METRICS_LOG")
+METRICS_EXPORT_SECONDS = 15
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# --- PROCESS SINGLETONS ---
+# Pools, queues, registries and background threads are shared by every session in the process:
+# the factory runs on first use (once per distinct arguments) and later calls return the same object
+def process_singleton(factory):
+    instances = {}
+    lock = threading.Lock()
+
+    @functools.wraps(factory)
+    def get(*args):
+        try:
+            return instances[args]
+        except KeyError:
+            pass
+        with lock:
+            if args not in instances:
+                instances[args] = factory(*args)
+            return instances[args]
+
+    return get
+
+# --- INSTRUMENTATION ---
+# Queries are counted per thread through each connection's trace callback; the rerun being traced
+# on this thread (if any) also collects per-phase and per-function totals
+_metrics_local = threading.local()
+
+def count_query(statement, n=1):
+    _metrics_local.queries = getattr(_metrics_local, "queries", 0) + n
+
+def thread_query_count():
+    return getattr(_metrics_local, "queries", 0)
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(METRICS_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}  # function -> {"seconds": Histogram, "errors", "queries", "rows"}
+        self.phases = {}  # render phase -> Histogram
+        self.reruns = Histogram()
+        self.rerun_queries = 0
+        self._log = open(METRICS_LOG, "a", encoding="utf-8", buffering=1) if METRICS_LOG else None
+
+    def record_call(self, name, seconds, queries, rows, failed):
+        with self._lock:
+            stats = self.calls.get(name)
+            if stats is None:
+                stats = self.calls[name] = {"seconds": Histogram(), "errors": 0, "queries": 0, "rows": 0}
+            stats["seconds"].observe(seconds)
+            stats["errors"] += failed
+            stats["queries"] += queries
+            stats["rows"] += rows
+
+    def record_rerun(self, trace):
+        record = trace.as_dict()
+        with self._lock:
+            for name, seconds in trace.phases.items():
+                self.phases.setdefault(name, Histogram()).observe(seconds)
+            self.reruns.observe(trace.duration)
+            self.rerun_queries += trace.queries
+            if self._log:
+                self._log.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def summary(self):
+        with self._lock:
+            return {
+                name: {
+                    "calls": stats["seconds"].count,
+                    "errors": stats["errors"],
+                    "avg_ms": stats["seconds"].sum / stats["seconds"].count * 1000,
+                    "queries": stats["queries"],
+                    "rows": stats["rows"],
+                }
+                for name, stats in sorted(self.calls.items())
+            }
+
+    def prometheus_text(self):
+        lines = []
+
+        def histogram(metric, help_text, series):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for labels, hist in series:
+                sep = "," if labels else ""
+                for bound, count in zip(METRICS_BUCKETS, hist.buckets):
+                    lines.append(f'{metric}_bucket{{{labels}{sep}le="{bound}"}} {count}')
+                lines.append(f'{metric}_bucket{{{labels}{sep}le="+Inf"}} {hist.count}')
+                suffix = f"{{{labels}}}" if labels else ""
+                lines.append(f"{metric}_sum{suffix} {hist.sum:.6f}")
+                lines.append(f"{metric}_count{suffix} {hist.count}")
+
+        def counter(metric, help_text, series):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for labels, value in series:
+                lines.append(f"{metric}{{{labels}}} {value}" if labels else f"{metric} {value}")
+
+        with self._lock:
+            calls = sorted(self.calls.items())
+            histogram("privatechat_data_call_seconds", "Wall time of data-access calls.",
+                      [(f'function="{name}"', stats["seconds"]) for name, stats in calls])
+            counter("privatechat_data_call_errors_total", "Data-access calls that raised.",
+                    [(f'function="{name}"', stats["errors"]) for name, stats in calls])
+            counter("privatechat_data_queries_total", "SQL statements run by data-access calls, including SQLite-internal ones such as full-text index lookups.",
+                    [(f'function="{name}"', stats["queries"]) for name, stats in calls])
+            counter("privatechat_data_rows_total", "Rows returned by data-access calls.",
+                    [(f'function="{name}"', stats["rows"]) for name, stats in calls])
+            histogram("privatechat_render_phase_seconds", "Wall time of page render phases.",
+                      [(f'phase="{name}"', hist) for name, hist in sorted(self.phases.items())])
+            histogram("privatechat_rerun_seconds", "Wall time of script reruns.", [("", self.reruns)])
+            counter("privatechat_rerun_queries_total", "SQL statements run by script reruns.", [("", self.rerun_queries)])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_file(self, path):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp, path)
+
+def export_metrics_periodically(registry):
+    while True:
+        time.sleep(METRICS_EXPORT_SECONDS)
+        try:
+            registry.write_prometheus_file(METRICS_FILE)
+        except OSError:
+            pass
+
+@process_singleton
+def get_metrics():
+    registry = MetricsRegistry()
+    if METRICS_FILE:
+        threading.Thread(target=export_metrics_periodically, args=(registry,), name="metrics-export", daemon=True).start()
+        atexit.register(registry.write_prometheus_file, METRICS_FILE)
+    return registry
+
+# One script run. Phases are consecutive: starting one ends the previous. Reruns cut short by
+# st.rerun() or st.stop() are finished when the session's next run begins, ending at their last activity.
+class RerunTrace:
+    def __init__(self, user):
+        self.user = user
+        self.started_at = time.time()
+        self.started = self.last_activity = time.perf_counter()
+        self.phases = {}
+        self.calls = {}  # function -> [calls, seconds, queries, rows]
+        self.queries = 0
+        self.rows = 0
+        self.duration = None
+        self._phase = None
+        self._phase_started = None
+
+    def phase(self, name):
+        now = time.perf_counter()
+        if self._phase is not None:
+            self.phases[self._phase] = self.phases.get(self._phase, 0.0) + now - self._phase_started
+        self._phase, self._phase_started = name, now
+        self.last_activity = now
+
+    def record_call(self, name, seconds, queries, rows):
+        totals = self.calls.setdefault(name, [0, 0.0, 0, 0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += queries
+        totals[3] += rows
+        self.queries += queries
+        self.rows += rows
+        self.last_activity = time.perf_counter()
+
+    def finish(self, end=None):
+        if self.duration is not None:
+            return
+        end = end or time.perf_counter()
+        if self._phase is not None:
+            self.phases[self._phase] = self.phases.get(self._phase, 0.0) + max(0.0, end - self._phase_started)
+            self._phase = None
+        self.duration = end - self.started
+        get_metrics().record_rerun(self)
+
+    def as_dict(self):
+        return {
+            "ts": datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(),
+            "user": self.user,
+            "duration_ms": round(self.duration * 1000, 3),
+            "queries": self.queries,
+            "rows": self.rows,
+            "phases_ms": {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()},
+            "calls": {
+                name: {"calls": calls, "ms": round(seconds * 1000, 3), "queries": queries, "rows": rows}
+                for name, (calls, seconds, queries, rows) in self.calls.items()
+            },
+        }
+
+def begin_rerun_trace(user, previous=None):
+    if previous is not None:
+        previous.finish(previous.last_activity)
+    trace = RerunTrace(user)
+    _metrics_local.trace = trace
+    return trace
+
+def end_rerun_trace(trace):
+    trace.finish()
+    if getattr(_metrics_local, "trace", None) is trace:
+        _metrics_local.trace = None
+
+def count_rows(result):
+    if result is None or isinstance(result, (bool, int, float, str, bytes)):
+        return 0 if result is None or result is False else 1
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        return len(result[0])  # (rows, total, ...) page results
+    if isinstance(result, (list, dict, set)):
+        return len(result)
+    return 1
+
+# Wraps a data-access function: wall time, statements issued on this thread and rows returned go to
+# the process-wide registry and to the rerun being traced on this thread
+def instrumented(fn):
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        queries_before = thread_query_count()
+        started = time.perf_counter()
+        result, failed = None, True
+        try:
+            result = fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            seconds = time.perf_counter() - started
+            queries = thread_query_count() - queries_before
+            rows = count_rows(result)
+            get_metrics().record_call(name, seconds, queries, rows, failed)
+            trace = getattr(_metrics_local, "trace", None)
+            if trace is not None:
+                trace.record_call(name, seconds, queries, rows)
+
+    return wrapper
+
+# --- DATABASE CONNECTIONS ---
+# Pooled connections are shared by every session and survive reruns (see get_pool)
+def open_connection(db_name, isolation_level=""):
+    conn = sqlite3.connect(
+        db_name,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE_SIZE,
+        isolation_level=isolation_level,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.create_function("search_scope", 1, search_scope, deterministic=True)
+    conn.set_trace_callback(count_query)
+    return conn
+
+class ConnectionPool:
+    def __init__(self, db_name, size=DB_POOL_SIZE):
+        self.db_name = db_name
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _open(self):
+        return open_connection(self.db_name)
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+@process_singleton
+def get_pool(db_name=DB_NAME):
+    return ConnectionPool(db_name)
+
+@contextmanager
+def get_db():
+    with get_pool(DB_NAME).connection() as conn:
+        yield conn
+
+# Single writer thread with its own connection. Each queued write is a function of the connection;
+# a batch runs in one transaction, every write inside its own savepoint so a failing write only
+# fails its own future.
+class WriteQueue:
+    def __init__(self, db_name):
+        self._conn = open_connection(db_name, isolation_level=None)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._queue.put((fn, args, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + WRITE_BATCH_LATENCY_SECONDS
+            while len(batch) < WRITE_BATCH_MAX:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        conn = self._conn
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, args, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT write_op")
+                queries_before = thread_query_count()
+                try:
+                    outcomes.append((future, fn(conn, *args), None))
+                except Exception as exc:
+                    conn.execute("ROLLBACK TO write_op")
+                    outcomes.append((future, None, exc))
+                future.queries = thread_query_count() - queries_before
+                conn.execute("RELEASE write_op")
+            conn.execute("COMMIT")
+        except Exception as exc:
+            if conn.in_transaction:
+                conn.rollback()
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for future, result, exc in outcomes:
+            if exc is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exc)
+
+@process_singleton
+def get_write_queue(db_name=DB_NAME):
+    return WriteQueue(db_name)
+
+# Runs fn(conn, *args) on the writer thread and waits for its batch to commit.
+# The statements it ran are counted on the calling thread, for instrumentation.
+def run_write(fn, *args):
+    future = get_write_queue(DB_NAME).submit(fn, *args)
+    try:
+        return future.result()
+    finally:
+        count_query(None, getattr(future, "queries", 0))
+
+# --- CACHES ---
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+@process_singleton
+def get_reply_preview_cache():
+    return LRUCache(REPLY_PREVIEW_CACHE_SIZE)
+
+@process_singleton
+def get_session_cache():
+    return LRUCache(SESSION_CACHE_SIZE)
+
+# --- LIVE EVENTS ---
+class Subscription:
+    def __init__(self, topics, max_pending=256):
+        self.topics = set(topics)
+        self._pending = deque(maxlen=max_pending)
+        self._lock = threading.Lock()
+
+    def notify(self, event):
+        with self._lock:
+            self._pending.append(event)
+
+    def drain(self):
+        with self._lock:
+            events = list(self._pending)
+            self._pending.clear()
+        return events
+
+# In-process pub/sub: writers publish after commit, sessions subscribe to the conversations they show
+class EventBroker:
+    def __init__(self):
+        self._subscriptions = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics):
+        subscription = Subscription(topics)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, topic, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if topic in subscription.topics:
+                subscription.notify(event)
+
+@process_singleton
+def get_broker():
+    return EventBroker()
+
+# Users coming online are published under this topic; conversation ids never take this form
+PRESENCE_TOPIC = "presence"
+
+# New messages are also published to each member of a private conversation under their user topic,
+# so sessions hear about conversations they were not subscribed to yet
+def user_topic(username):
+    return f"user:{username}"
+
+# Publishes a committed change to this process's subscribers, after dropping what it made stale
+def deliver_change(change):
+    conversation_id = change["conversation_id"]
+    if change["kind"] == "edit":
+        get_reply_preview_cache().invalidate(change["message_id"])
+    get_broker().publish(conversation_id, change)
+    if change["kind"] == "insert" and conversation_id != "global":
+        for member in json.loads(conversation_id):
+            get_broker().publish(user_topic(member), change)
+
+def publish_change(change):
+    if change:
+        deliver_change(change)
+        notifier = get_notifier()
+        if notifier is not None:
+            notifier.broadcast(change["conversation_id"], change)
+
+# --- CROSS-PROCESS NOTIFICATIONS ---
+# Delivery is best effort: a datagram dropped because a peer is backed up, or sent before a new process
+# was discovered, is picked up by that process's change feed poll and presence sync instead
+class ChangeNotifier:
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = os.path.abspath(folder)
+        self.path = os.path.join(self.folder, f"notify-{os.getpid()}-{uuid.uuid4().hex[:8]}.sock")
+        self._inbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._inbox.bind(self.path)
+        self._outbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._outbox.setblocking(False)
+        self._peers = []
+        self._peers_checked = None
+        self._lock = threading.Lock()
+
+    def peers(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._peers_checked is None or now - self._peers_checked >= NOTIFY_PEER_REFRESH_SECONDS:
+                try:
+                    names = os.listdir(self.folder)
+                except OSError:
+                    names = []
+                self._peers = [
+                    path for path in (os.path.join(self.folder, name) for name in names
+                                      if name.startswith("notify-") and name.endswith(".sock"))
+                    if path != self.path
+                ]
+                self._peers_checked = now
+            return self._peers
+
+    def broadcast(self, topic, event):
+        payload = json.dumps({"topic": topic, "event": event}, separators=(",", ":")).encode("utf-8")
+        for peer in self.peers():
+            try:
+                self._outbox.sendto(payload, peer)
+            except ConnectionRefusedError:
+                # Nobody is bound to it: left behind by a process that did not exit cleanly
+                try:
+                    os.remove(peer)
+                except FileNotFoundError:
+                    pass
+            except OSError:
+                pass  # backed up or gone; see above
+
+    def listen(self):
+        while True:
+            try:
+                payload = self._inbox.recv(NOTIFY_MAX_BYTES)
+            except OSError:
+                return
+            try:
+                message = json.loads(payload)
+                topic, event = message["topic"], message["event"]
+                if topic == PRESENCE_TOPIC:
+                    get_presence().merge(event["username"], event["ms"])
+                else:
+                    deliver_change(event)
+            except (ValueError, TypeError, KeyError, AttributeError):
+                continue  # malformed or from an incompatible version; the listener must keep running
+
+    def close(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self._inbox.close()
+        self._outbox.close()
+
+# None when notifications are disabled or unavailable (no Unix sockets, unwritable data directory)
+@process_singleton
+def get_notifier():
+    if NOTIFY_FOLDER is None or not hasattr(socket, "AF_UNIX"):
+        return None
+    try:
+        notifier = ChangeNotifier(NOTIFY_FOLDER)
+    except OSError:
+        return None
+    threading.Thread(target=notifier.listen, name="change-notifier", daemon=True).start()
+    atexit.register(notifier.close)
+    return notifier
+
+# --- DATABASE SETUP ---
+def table_exists(c, name):
+    row = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone()
+    return row is not None
+
+def column_exists(c, table, column):
+    return any(row[1] == column for row in c.execute(f"PRAGMA table_info({table})"))
+
+# SQL equivalent of conversation_key() for a messages row
+CONVERSATION_ID_SQL = """
+    CASE
+        WHEN recipient IS NULL THEN 'global'
+        WHEN username < recipient THEN json_array(username, recipient)
+        ELSE json_array(recipient, username)
+    END
+"""
+
+# --- SCHEMA MIGRATIONS ---
+# Each migration upgrades the schema by one version (tracked in PRAGMA user_version) and runs inside
+# the transaction opened by init_db. Version 1 brings any database created before versioning up to
+# the first versioned schema, so every step in it must tolerate objects that already exist.
+def migrate_v1_baseline(c):
+    # Messages table with reply_to
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            recipient TEXT,
+            timestamp TEXT NOT NULL,
+            type TEXT NOT NULL,
+            content TEXT,
+            file_path TEXT,
+            reply_to TEXT
+        )
+    """)
+    # Online users
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS users_online (
+            username TEXT PRIMARY KEY,
+            last_seen TEXT NOT NULL
+        )
+    """)
+    # User PINs for login
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS user_pins (
+            username TEXT PRIMARY KEY,
+            pin_hash TEXT NOT NULL
+        )
+    """)
+    # Likes table
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS message_likes (
+            message_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            PRIMARY KEY (message_id, username),
+            FOREIGN KEY (message_id) REFERENCES messages(id),
+            FOREIGN KEY (username) REFERENCES user_pins(username)
+        )
+    """)
+    # Indexes backing keyset pagination for global and private chats
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_recipient_ts ON messages (recipient, timestamp, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_pair_ts ON messages (username, recipient, timestamp, id)")
+    # Per-conversation message totals, maintained by save_message
+    if not table_exists(c, "conversation_counts"):
+        c.execute("""
+            CREATE TABLE conversation_counts (
+                conversation_id TEXT PRIMARY KEY,
+                total INTEGER NOT NULL
+            )
+        """)
+        # Global chat is always stored with a NULL recipient so it can use the index
+        c.execute("UPDATE messages SET recipient = NULL WHERE recipient = ''")
+        c.execute(f"""
+            INSERT INTO conversation_counts (conversation_id, total)
+            SELECT {CONVERSATION_ID_SQL} AS conversation_id, COUNT(*)
+            FROM messages
+            GROUP BY conversation_id
+        """)
+    # Full-text index over message content, kept in sync by save_message and update_message_content.
+    # messages.search_rowid points at the row's entry so it can be replaced without scanning the index.
+    if not column_exists(c, "messages", "search_rowid"):
+        c.execute("ALTER TABLE messages ADD COLUMN search_rowid INTEGER")
+    if not table_exists(c, "messages_fts"):
+        c.execute("""
+            CREATE VIRTUAL TABLE messages_fts USING fts5(
+                content,
+                message_id UNINDEXED,
+                conversation_id UNINDEXED,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        """)
+        c.execute(f"""
+            INSERT INTO messages_fts (rowid, content, message_id, conversation_id)
+            SELECT rowid, content, id, {CONVERSATION_ID_SQL}
+            FROM messages WHERE content IS NOT NULL
+        """)
+        c.execute("UPDATE messages SET search_rowid = rowid WHERE content IS NOT NULL")
+    # Denormalized like totals, kept consistent by add_like/remove_like
+    if not column_exists(c, "messages", "like_count"):
+        c.execute("ALTER TABLE messages ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0")
+        c.execute("""
+            UPDATE messages
+            SET like_count = (SELECT COUNT(*) FROM message_likes WHERE message_id = messages.id)
+            WHERE id IN (SELECT message_id FROM message_likes)
+        """)
+    # Content-addressed upload blobs with reference counts; messages keep the original file name
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS upload_blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL
+        )
+    """)
+    if not column_exists(c, "messages", "file_name"):
+        c.execute("ALTER TABLE messages ADD COLUMN file_name TEXT")
+    # Attachment metadata recorded at upload time, so pages render without touching the files
+    if not column_exists(c, "messages", "file_size"):
+        c.execute("ALTER TABLE messages ADD COLUMN file_size INTEGER")
+        c.execute("ALTER TABLE messages ADD COLUMN mime_type TEXT")
+        rows = c.execute("SELECT id, file_path, file_name FROM messages WHERE file_path IS NOT NULL").fetchall()
+        for msg_id, file_path, file_name in rows:
+            file_name = file_name or os.path.basename(file_path).split("_", 1)[-1]
+            try:
+                file_size = os.path.getsize(resolve_file_path(file_path))
+            except OSError:
+                file_size = None
+            c.execute(
+                "UPDATE messages SET file_name = ?, file_size = ?, mime_type = ? WHERE id = ?",
+                (file_name, file_size, guess_mime_type(file_name), msg_id),
+            )
+    # Numeric last-seen time for the indexed cold presence lookup
+    if not column_exists(c, "users_online", "last_seen_ms"):
+        c.execute("ALTER TABLE users_online ADD COLUMN last_seen_ms INTEGER NOT NULL DEFAULT 0")
+        c.execute("UPDATE users_online SET last_seen_ms = CAST((julianday(last_seen) - 2440587.5) * 86400000 AS INTEGER)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_online_last_seen ON users_online (last_seen_ms)")
+    # Change feed of inserts, edits and like toggles, read by get_changes_since
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS message_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            kind TEXT NOT NULL
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_message_changes_conversation ON message_changes (conversation_id, seq)")
+
+# Normalized conversation key and integer epoch-millisecond timestamps, with one composite index
+# serving every conversation's pages (replacing the recipient and sender/recipient indexes)
+def migrate_v2_conversation_ts(c):
+    c.execute("ALTER TABLE messages ADD COLUMN conversation_id TEXT")
+    c.execute("ALTER TABLE messages ADD COLUMN ts INTEGER")
+    c.execute(f"""
+        UPDATE messages SET
+            conversation_id = {CONVERSATION_ID_SQL},
+            ts = CAST(ROUND((julianday(timestamp) - 2440587.5) * 86400000) AS INTEGER)
+    """)
+    c.execute("CREATE INDEX idx_messages_conversation_ts ON messages (conversation_id, ts, id)")
+    c.execute("DROP INDEX IF EXISTS idx_messages_recipient_ts")
+    c.execute("DROP INDEX IF EXISTS idx_messages_pair_ts")
+
+# Per-message version counters, bumped by edits and like toggles, used as render cache keys
+def migrate_v3_message_versions(c):
+    c.execute("ALTER TABLE messages ADD COLUMN content_version INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE messages ADD COLUMN like_version INTEGER NOT NULL DEFAULT 0")
+
+# Archival bookkeeping: which monthly archives hold each conversation's messages, and a time index
+# for finding the oldest messages to move
+def migrate_v4_archive(c):
+    c.execute("""
+        CREATE TABLE archived_ranges (
+            conversation_id TEXT NOT NULL,
+            month TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            PRIMARY KEY (conversation_id, month)
+        )
+    """)
+    c.execute("CREATE INDEX idx_messages_ts ON messages (ts)")
+
+# Read cursors: how many of a conversation's messages each user has seen. Unread counts are
+# conversation_counts.total minus read_total; the member columns find a user's conversations.
+# Existing users start with everything read.
+def migrate_v5_read_cursors(c):
+    c.execute("ALTER TABLE conversation_counts ADD COLUMN member_a TEXT")
+    c.execute("ALTER TABLE conversation_counts ADD COLUMN member_b TEXT")
+    c.execute("""
+        UPDATE conversation_counts SET
+            member_a = json_extract(conversation_id, '$[0]'),
+            member_b = json_extract(conversation_id, '$[1]')
+        WHERE conversation_id != 'global'
+    """)
+    c.execute("CREATE INDEX idx_conversation_counts_member_a ON conversation_counts (member_a)")
+    c.execute("CREATE INDEX idx_conversation_counts_member_b ON conversation_counts (member_b)")
+    c.execute("""
+        CREATE TABLE read_cursors (
+            username TEXT NOT NULL,
+            conversation_id TEXT NOT NULL,
+            read_total INTEGER NOT NULL,
+            PRIMARY KEY (username, conversation_id)
+        )
+    """)
+    c.execute("""
+        INSERT INTO read_cursors (username, conversation_id, read_total)
+        SELECT u.username, cc.conversation_id, cc.total
+        FROM user_pins u JOIN conversation_counts cc
+            ON cc.conversation_id = 'global' OR u.username IN (cc.member_a, cc.member_b)
+    """)
+
+# Byte offset reached by each bulk import (chat_transfer.py), committed with every batch so an
+# interrupted import resumes where it stopped
+def migrate_v6_import_progress(c):
+    c.execute("""
+        CREATE TABLE import_progress (
+            export_id TEXT PRIMARY KEY,
+            offset INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+
+# Session tokens (see create_session) and the key they are signed with, shared by every process
+def migrate_v7_sessions(c):
+    c.execute("""
+        CREATE TABLE session_tokens (
+            token_hash TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            expires_ms INTEGER NOT NULL
+        )
+    """)
+    c.execute("CREATE INDEX idx_session_tokens_expires ON session_tokens (expires_ms)")
+    c.execute("CREATE TABLE app_secrets (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    c.execute("INSERT INTO app_secrets (name, value) VALUES ('session_signing_key', ?)", (secrets.token_hex(32),))
+
+# Search entries carry an indexed scope token for their conversation, so a search matches within the
+# conversation instead of matching every conversation and filtering afterwards (see search_scope).
+# Ranking ignores the scope column.
+MESSAGES_FTS_SQL = """
+    CREATE VIRTUAL TABLE messages_fts USING fts5(
+        content,
+        scope,
+        message_id UNINDEXED,
+        conversation_id UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+"""
+
+def migrate_v8_search_scope(c):
+    c.execute("DROP TABLE messages_fts")
+    c.execute(MESSAGES_FTS_SQL)
+    c.execute("INSERT INTO messages_fts (messages_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')")
+    c.execute("""
+        INSERT INTO messages_fts (rowid, content, scope, message_id, conversation_id)
+        SELECT search_rowid, content, search_scope(conversation_id), id, conversation_id
+        FROM messages WHERE search_rowid IS NOT NULL
+    """)
+
+MIGRATIONS = [
+    migrate_v1_baseline,
+    migrate_v2_conversation_ts,
+    migrate_v3_message_versions,
+    migrate_v4_archive,
+    migrate_v5_read_cursors,
+    migrate_v6_import_progress,
+    migrate_v7_sessions,
+    migrate_v8_search_scope,
+]
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+# Runs once per process; later calls (one per rerun in the app) return without touching the database
+@process_singleton
+@instrumented
+def init_db():
+    with get_db() as conn:
+        if get_schema_version(conn) < len(MIGRATIONS):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Re-read under the write lock: another process may have migrated in the meantime
+                for version in range(get_schema_version(conn), len(MIGRATIONS)):
+                    MIGRATIONS[version](conn.cursor())
+                    conn.execute(f"PRAGMA user_version = {version + 1}")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    upgrade_archives()
+
+def conversation_key(current_user, chat_with=None):
+    if not chat_with:
+        return "global"
+    return json.dumps(sorted([current_user, chat_with]), separators=(",", ":"), ensure_ascii=False)
+
+PIN_HASH_SCHEME = "pbkdf2_sha256"
+
+def hash_pin(pin, salt=None, iterations=PIN_KDF_ITERATIONS):
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", pin.encode("utf-8"), salt, iterations)
+    return f"{PIN_HASH_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+# (matches, outdated). PINs stored before PBKDF2 are bare SHA-256 hex digests; those and hashes with
+# fewer than PIN_KDF_ITERATIONS rounds are outdated and get rehashed on the next successful login.
+def check_pin_hash(stored_hash, pin):
+    if not stored_hash.startswith(PIN_HASH_SCHEME + "$"):
+        legacy = hashlib.sha256(pin.encode("utf-8")).hexdigest()
+        return hmac.compare_digest(stored_hash, legacy), True
+    _, iterations, salt, digest = stored_hash.split("$")
+    candidate = hashlib.pbkdf2_hmac("sha256", pin.encode("utf-8"), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(candidate.hex(), digest), int(iterations) < PIN_KDF_ITERATIONS
+
+@instrumented
+def register_user_pin(username, pin):
+    pin_hash = hash_pin(pin)
+
+    def write(conn):
+        conn.execute("""
+            INSERT INTO user_pins (username, pin_hash) VALUES (?, ?)
+            ON CONFLICT(username) DO UPDATE SET pin_hash=excluded.pin_hash
+        """, (username, pin_hash))
+        # New users start with the global history already read
+        conn.execute("""
+            INSERT OR IGNORE INTO read_cursors (username, conversation_id, read_total)
+            SELECT ?, conversation_id, total FROM conversation_counts WHERE conversation_id = 'global'
+        """, (username,))
+
+    run_write(write)
+
+@instrumented
+def get_user_pin_hash(username):
+    with get_db() as conn:
+        row = conn.execute("SELECT pin_hash FROM user_pins WHERE username = ?", (username,)).fetchone()
+    return row[0] if row else None
+
+@instrumented
+def verify_pin(username, pin):
+    stored_hash = get_user_pin_hash(username)
+    if not stored_hash:
+        return False
+    matches, outdated = check_pin_hash(stored_hash, pin)
+    if matches and outdated:
+        new_hash = hash_pin(pin)
+
+        def write(conn):
+            conn.execute(
+                "UPDATE user_pins SET pin_hash = ? WHERE username = ? AND pin_hash = ?",
+                (new_hash, username, stored_hash),
+            )
+
+        run_write(write)
+    return matches
+
+# PIN hashing takes a noticeable fraction of a second: the app runs register_user_pin and verify_pin
+# here and polls the returned Future, so the session's script thread is not held up
+@process_singleton
+def get_pin_pool():
+    return ThreadPoolExecutor(max_workers=PIN_KDF_WORKERS, thread_name_prefix="pin-kdf")
+
+def submit_pin_task(fn, *args):
+    return get_pin_pool().submit(fn, *args)
+
+# --- SESSIONS ---
+# A token is "<id>.<expires ms>.<HMAC-SHA256 of both>": forged, damaged and expired tokens are
+# rejected without a query. SQLite only holds a hash of the id, so a copy of the database cannot
+# be used to log in.
+@process_singleton
+def get_session_key():
+    with get_db() as conn:
+        row = conn.execute("SELECT value FROM app_secrets WHERE name = 'session_signing_key'").fetchone()
+    return bytes.fromhex(row[0])
+
+def sign_session(token_id, expires_ms):
+    return hmac.new(get_session_key(), f"{token_id}.{expires_ms}".encode("ascii"), hashlib.sha256).hexdigest()
+
+def session_token_hash(token_id):
+    return hashlib.sha256(token_id.encode("ascii")).hexdigest()
+
+@instrumented
+def create_session(username):
+    token_id = secrets.token_urlsafe(18)
+    now_ms = int(time.time() * 1000)
+    expires_ms = now_ms + SESSION_TTL_SECONDS * 1000
+
+    def write(conn):
+        conn.execute("DELETE FROM session_tokens WHERE expires_ms <= ?", (now_ms,))
+        conn.execute(
+            "INSERT INTO session_tokens (token_hash, username, expires_ms) VALUES (?, ?, ?)",
+            (session_token_hash(token_id), username, expires_ms),
+        )
+
+    run_write(write)
+    get_session_cache().put(token_id, (username, time.monotonic()))
+    return f"{token_id}.{expires_ms}.{sign_session(token_id, expires_ms)}"
+
+# Username of a valid session token, or None when it is malformed, forged, expired or logged out
+@instrumented
+def resume_session(token):
+    if not isinstance(token, str) or not token.isascii():
+        return None
+    try:
+        token_id, expires, signature = token.split(".")
+        expires_ms = int(expires)
+    except ValueError:
+        return None
+    now_ms = int(time.time() * 1000)
+    if expires_ms <= now_ms or not hmac.compare_digest(signature, sign_session(token_id, expires_ms)):
+        return None
+    cache = get_session_cache()
+    cached = cache.get(token_id)
+    if cached is not None and time.monotonic() - cached[1] < SESSION_RECHECK_SECONDS:
+        return cached[0]
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT username FROM session_tokens WHERE token_hash = ? AND expires_ms > ?",
+            (session_token_hash(token_id), now_ms),
+        ).fetchone()
+    if row is None:
+        cache.invalidate(token_id)
+        return None
+    cache.put(token_id, (row[0], time.monotonic()))
+    return row[0]
+
+@instrumented
+def end_session(token):
+    token_id = token.split(".")[0]
+    get_session_cache().invalidate(token_id)
+
+    def write(conn):
+        conn.execute("DELETE FROM session_tokens WHERE token_hash = ?", (session_token_hash(token_id),))
+
+    run_write(write)
+
+# --- UPLOAD STORAGE ---
+def blob_path(digest):
+    return os.path.join(UPLOAD_FOLDER, "blobs", digest[:2], digest)
+
+# Maps a messages.file_path value to a path on disk; rows from before the blob store hold plain paths
+def resolve_file_path(file_path):
+    if file_path and file_path.startswith(BLOB_REF_PREFIX):
+        return blob_path(file_path[len(BLOB_REF_PREFIX):])
+    return file_path
+
+def guess_mime_type(file_name):
+    return mimetypes.guess_type(file_name or "")[0] or "application/octet-stream"
+
+@instrumented
+def read_upload(file_path):
+    with open(resolve_file_path(file_path), "rb") as f:
+        return f.read()
+
+def format_file_size(size):
+    if size is None:
+        return "unknown size"
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+# Streams an upload to a temporary file in fixed-size chunks while hashing it.
+# Returns (temp_path, sha256 hex digest, size); commit_upload then moves it into the blob store.
+def stage_upload(file_obj):
+    tmp_dir = os.path.join(UPLOAD_FOLDER, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as tmp:
+        try:
+            while chunk := file_obj.read(UPLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+    return tmp.name, digest.hexdigest(), size
+
+# Adds a reference to a staged upload inside the caller's write transaction. The refcount upsert
+# runs first so the blob file is only created or reused while holding the database write lock.
+# Messages are never deleted, so references are only ever added; refcount records how many
+# messages share a blob for when a delete path exists.
+def commit_upload(conn, tmp_path, digest, size):
+    conn.execute("""
+        INSERT INTO upload_blobs (hash, size, refcount) VALUES (?, ?, 1)
+        ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1
+    """, (digest, size))
+    path = blob_path(digest)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    return BLOB_REF_PREFIX + digest
+
+# --- THUMBNAILS ---
+@process_singleton
+def get_thumbnail_pool():
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+def schedule_thumbnails(file_path):
+    return get_thumbnail_pool().submit(thumbnails.make_thumbnails, resolve_file_path(file_path), THUMBNAIL_SIZES)
+
+# Path of the chat-sized preview of an image message, or None until it has been generated
+@instrumented
+def get_thumbnail(file_path):
+    path = thumbnails.thumbnail_path(resolve_file_path(file_path), THUMBNAIL_SIZES[0])
+    return path if os.path.exists(path) else None
+
+# Queues previews for images stored before thumbnails existed, walking messages in rowid batches
+def backfill_thumbnails():
+    last_rowid = 0
+    while True:
+        with get_db() as conn:
+            rows = conn.execute(
+                "SELECT rowid, file_path FROM messages WHERE type = 'image' AND file_path IS NOT NULL AND rowid > ? "
+                "ORDER BY rowid LIMIT ?",
+                (last_rowid, THUMBNAIL_BACKFILL_BATCH),
+            ).fetchall()
+        if not rows:
+            return
+        last_rowid = rows[-1][0]
+        pending = [
+            schedule_thumbnails(file_path)
+            for file_path in {file_path for _, file_path in rows}
+            if get_thumbnail(file_path) is None and os.path.exists(resolve_file_path(file_path))
+        ]
+        for future in pending:
+            future.exception()  # wait for the batch; broken images are simply left without a preview
+
+@process_singleton
+def start_thumbnail_backfill():
+    thread = threading.Thread(target=backfill_thumbnails, name="thumbnail-backfill", daemon=True)
+    thread.start()
+    return thread
+
+# --- ARCHIVE ---
+# Old messages and their likes live in ARCHIVE_FOLDER/messages-YYYY-MM.db, with their own search index.
+# archived_ranges lists the months holding each conversation's messages, so reads only attach an
+# archive when a page or search actually reaches into it. Archived messages are read-only.
+ARCHIVE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS archive.messages (
+        id TEXT PRIMARY KEY,
+        username TEXT NOT NULL,
+        recipient TEXT,
+        timestamp TEXT NOT NULL,
+        type TEXT NOT NULL,
+        content TEXT,
+        file_path TEXT,
+        reply_to TEXT,
+        like_count INTEGER NOT NULL DEFAULT 0,
+        file_name TEXT,
+        file_size INTEGER,
+        mime_type TEXT,
+        content_version INTEGER NOT NULL DEFAULT 0,
+        like_version INTEGER NOT NULL DEFAULT 0,
+        conversation_id TEXT NOT NULL,
+        ts INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS archive.idx_messages_conversation_ts ON messages (conversation_id, ts, id)",
+    """
+    CREATE TABLE IF NOT EXISTS archive.message_likes (
+        message_id TEXT NOT NULL,
+        username TEXT NOT NULL,
+        PRIMARY KEY (message_id, username)
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS archive.messages_fts USING fts5(
+        content,
+        scope,
+        message_id UNINDEXED,
+        conversation_id UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    "INSERT INTO archive.messages_fts (messages_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+]
+
+# Kept in each archive's user_version. Version 1 added the search scope column and version 2 the
+# hot index's tokenizer (see MESSAGES_FTS_SQL).
+ARCHIVE_SCHEMA_VERSION = 2
+
+def archive_path(month):
+    return os.path.join(ARCHIVE_FOLDER, f"messages-{month}.db")
+
+def month_of(ts):
+    return datetime.fromtimestamp(ts / 1000, timezone.utc).strftime("%Y-%m")
+
+@contextmanager
+def attached_archive(conn, month):
+    conn.execute("ATTACH DATABASE ? AS archive", (archive_path(month),))
+    try:
+        yield conn
+    finally:
+        conn.execute("DETACH DATABASE archive")
+
+# Brings the attached archive's schema up to ARCHIVE_SCHEMA_VERSION, inside the caller's transaction
+def upgrade_archive_schema(conn):
+    if conn.execute("PRAGMA archive.user_version").fetchone()[0] >= ARCHIVE_SCHEMA_VERSION:
+        return
+    conn.execute("DROP TABLE IF EXISTS archive.messages_fts")
+    for statement in ARCHIVE_SCHEMA:
+        conn.execute(statement)
+    conn.execute("""
+        INSERT INTO archive.messages_fts (rowid, content, scope, message_id, conversation_id)
+        SELECT rowid, content, search_scope(conversation_id), id, conversation_id
+        FROM archive.messages WHERE content IS NOT NULL
+    """)
+    conn.execute(f"PRAGMA archive.user_version = {ARCHIVE_SCHEMA_VERSION}")
+
+# Upgrades archives written by older versions; run once per process by init_db
+def upgrade_archives():
+    if not os.path.isdir(ARCHIVE_FOLDER):
+        return
+    months = sorted(
+        match.group(1) for match in (re.fullmatch(r"messages-(\d{4}-\d{2})\.db", name) for name in os.listdir(ARCHIVE_FOLDER))
+        if match
+    )
+    conn = open_connection(DB_NAME, isolation_level=None)
+    try:
+        for month in months:
+            with attached_archive(conn, month):
+                if conn.execute("PRAGMA archive.user_version").fetchone()[0] >= ARCHIVE_SCHEMA_VERSION:
+                    continue
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    upgrade_archive_schema(conn)  # re-checks under the write lock
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+    finally:
+        conn.close()
+
+# Months holding archived messages of a conversation, newest first
+def get_archive_months(conn, conversation_id):
+    rows = conn.execute(
+        "SELECT month FROM archived_ranges WHERE conversation_id = ? ORDER BY month DESC", (conversation_id,)
+    ).fetchall()
+    return [month for (month,) in rows if os.path.exists(archive_path(month))]
+
+def find_archived_message(conn, conversation_id, msg_id, columns):
+    for month in get_archive_months(conn, conversation_id):
+        with attached_archive(conn, month):
+            row = conn.execute(f"SELECT {columns} FROM archive.messages WHERE id = ?", (msg_id,)).fetchone()
+        if row:
+            return row
+    return None
+
+# Copies messages (and likes and search entries) into a month's archive. Safe to repeat: rows are
+# upserted in place, so a copy whose hot rows were not removed afterwards is simply redone.
+# Returns the (id, content_version, like_version) that were copied, read in the same snapshot.
+def copy_to_archive(conn, month, message_ids):
+    columns = f"{MESSAGE_COLUMNS}, conversation_id, ts"
+    updates = ", ".join(f"{col} = excluded.{col}" for col in columns.split(", ") if col != "id")
+    placeholders = ", ".join("?" * len(message_ids))
+    os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+    with attached_archive(conn, month):
+        # Deferred: only the archive is written, so the hot database is never locked here
+        conn.execute("BEGIN")
+        try:
+            for statement in ARCHIVE_SCHEMA:
+                conn.execute(statement)
+            upgrade_archive_schema(conn)
+            versions = conn.execute(
+                f"SELECT id, content_version, like_version FROM main.messages WHERE id IN ({placeholders})",
+                message_ids,
+            ).fetchall()
+            conn.execute(f"""
+                INSERT INTO archive.messages ({columns})
+                SELECT {columns} FROM main.messages WHERE id IN ({placeholders})
+                ON CONFLICT(id) DO UPDATE SET {updates}
+            """, message_ids)
+            conn.execute(f"DELETE FROM archive.message_likes WHERE message_id IN ({placeholders})", message_ids)
+            conn.execute(f"""
+                INSERT INTO archive.message_likes (message_id, username)
+                SELECT message_id, username FROM main.message_likes WHERE message_id IN ({placeholders})
+            """, message_ids)
+            conn.execute(f"""
+                INSERT OR REPLACE INTO archive.messages_fts (rowid, content, scope, message_id, conversation_id)
+                SELECT rowid, content, search_scope(conversation_id), id, conversation_id FROM archive.messages
+                WHERE id IN ({placeholders}) AND content IS NOT NULL
+            """, message_ids)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    return versions
+
+# Writer-thread half of a move: drops the hot copies that are unchanged since they were archived.
+# Messages edited or liked in between keep their hot row and are archived again on the next pass.
+def remove_archived_messages(conn, month, versions):
+    moved = {}
+    for message_id, content_version, like_version in versions:
+        row = conn.execute(
+            "DELETE FROM messages WHERE id = ? AND content_version = ? AND like_version = ? "
+            "RETURNING conversation_id, search_rowid",
+            (message_id, content_version, like_version),
+        ).fetchone()
+        if row is None:
+            continue
+        conversation_id, search_rowid = row
+        conn.execute("DELETE FROM message_likes WHERE message_id = ?", (message_id,))
+        if search_rowid is not None:
+            conn.execute("DELETE FROM messages_fts WHERE rowid = ?", (search_rowid,))
+        moved[conversation_id] = moved.get(conversation_id, 0) + 1
+    conn.executemany("""
+        INSERT INTO archived_ranges (conversation_id, month, total) VALUES (?, ?, ?)
+        ON CONFLICT(conversation_id, month) DO UPDATE SET total = total + excluded.total
+    """, [(conversation_id, month, total) for conversation_id, total in moved.items()])
+    return sum(moved.values())
+
+# Moves everything older than ARCHIVE_AFTER_DAYS, oldest first, in small batches so that ordinary
+# writes keep flowing through the writer thread in between. Returns the number of messages moved.
+def archive_old_messages():
+    if ARCHIVE_AFTER_DAYS is None:
+        return 0
+    cutoff = int(time.time() * 1000) - ARCHIVE_AFTER_DAYS * 86400 * 1000
+    conn = open_connection(DB_NAME, isolation_level=None)
+    moved = 0
+    try:
+        while True:
+            rows = conn.execute(
+                "SELECT id, ts FROM messages WHERE ts < ? ORDER BY ts LIMIT ?", (cutoff, ARCHIVE_BATCH_SIZE)
+            ).fetchall()
+            by_month = {}
+            for message_id, ts in rows:
+                by_month.setdefault(month_of(ts), []).append(message_id)
+            batch_moved = 0
+            for month, message_ids in sorted(by_month.items()):
+                versions = copy_to_archive(conn, month, message_ids)
+                batch_moved += run_write(remove_archived_messages, month, versions)
+            if not batch_moved:
+                return moved
+            moved += batch_moved
+            time.sleep(ARCHIVE_BATCH_PAUSE_SECONDS)
+    finally:
+        conn.close()
+
+def run_archiver():
+    while True:
+        try:
+            archive_old_messages()
+        except (sqlite3.Error, OSError):
+            pass  # retried on the next pass
+        time.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+@process_singleton
+def start_archiver():
+    thread = threading.Thread(target=run_archiver, name="message-archiver", daemon=True)
+    thread.start()
+    return thread
+
+@instrumented
+def save_message(username, msg_type, content=None, file_obj=None, file_name=None, recipient=None, reply_to=None,
+                 file_bytes=None, mime_type=None):
+    if file_bytes is not None:
+        file_obj = io.BytesIO(file_bytes)
+    file_size = None
+    msg_id = str(uuid.uuid4())
+    recipient = recipient or None
+    now = datetime.now(timezone.utc)
+    timestamp, ts = now.isoformat(), int(now.timestamp() * 1000)
+    conversation_id = conversation_key(username, recipient)
+    staged = stage_upload(file_obj) if file_obj is not None and file_name else None
+    if staged:
+        file_size = staged[2]
+        mime_type = mime_type or guess_mime_type(file_name)
+    else:
+        file_name = mime_type = None
+
+    def write(conn):
+        file_path = commit_upload(conn, *staged) if staged else None
+        conn.execute("""
+            INSERT INTO messages (id, username, recipient, timestamp, type, content, file_path, reply_to,
+                                  file_name, file_size, mime_type, conversation_id, ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (msg_id, username, recipient, timestamp, msg_type, content, file_path, reply_to,
+              file_name, file_size, mime_type, conversation_id, ts))
+        members = sorted([username, recipient]) if recipient else [None, None]
+        total = conn.execute("""
+            INSERT INTO conversation_counts (conversation_id, total, member_a, member_b) VALUES (?, 1, ?, ?)
+            ON CONFLICT(conversation_id) DO UPDATE SET total = total + 1
+            RETURNING total
+        """, (conversation_id, *members)).fetchone()[0]
+        # Sending a message implies having read the conversation
+        mark_read(conn, username, conversation_id, total)
+        if content:
+            index_message_content(conn, msg_id, content, conversation_id)
+        return file_path, record_change(conn, conversation_id, msg_id, "insert")
+
+    try:
+        file_path, change = run_write(write)
+    finally:
+        if staged and os.path.exists(staged[0]):
+            os.remove(staged[0])
+    publish_change(change)
+    if msg_type == "image" and file_path:
+        try:
+            schedule_thumbnails(file_path)
+        except RuntimeError:
+            pass  # pool unavailable (e.g. shutting down): the image is shown full size until backfilled
+    return msg_id
+
+# Moves the user's read cursor forward to read_total (never back), inside the caller's transaction
+def mark_read(conn, username, conversation_id, read_total):
+    conn.execute("""
+        INSERT INTO read_cursors (username, conversation_id, read_total) VALUES (?, ?, ?)
+        ON CONFLICT(username, conversation_id) DO UPDATE SET read_total = MAX(read_total, excluded.read_total)
+    """, (username, conversation_id, read_total))
+
+# Never moves the cursor past the conversation's count; returns that count, so a caller whose page
+# total disagrees with it knows the page is stale
+@instrumented
+def mark_conversation_read(username, conversation_id, read_total):
+    def write(conn):
+        total = get_conversation_total(conn, conversation_id)
+        mark_read(conn, username, conversation_id, min(read_total, total))
+        return total
+
+    return run_write(write)
+
+# Unread message counts for every conversation the user is part of, in one query:
+# {conversation_id: (other user or None for the global chat, unread)}
+@instrumented
+def get_unread_counts(username):
+    with get_db() as conn:
+        rows = conn.execute("""
+            SELECT cc.conversation_id, cc.member_a, cc.member_b, cc.total - COALESCE(rc.read_total, 0)
+            FROM conversation_counts cc
+            LEFT JOIN read_cursors rc ON rc.username = ? AND rc.conversation_id = cc.conversation_id
+            WHERE cc.conversation_id = 'global' OR cc.member_a = ? OR cc.member_b = ?
+        """, (username, username, username)).fetchall()
+    return {
+        conversation_id: (member_b if member_a == username else member_a, max(0, unread))
+        for conversation_id, member_a, member_b, unread in rows
+    }
+
+# Appends to the change feed inside the caller's transaction; publish the result once committed
+def record_change(conn, conversation_id, message_id, kind):
+    cur = conn.execute(
+        "INSERT INTO message_changes (conversation_id, message_id, kind) VALUES (?, ?, ?)",
+        (conversation_id, message_id, kind),
+    )
+    if cur.lastrowid % CHANGE_LOG_PRUNE_EVERY == 0:
+        conn.execute("DELETE FROM message_changes WHERE seq <= ?", (cur.lastrowid - CHANGE_LOG_RETENTION,))
+    return {"seq": cur.lastrowid, "conversation_id": conversation_id, "message_id": message_id, "kind": kind}
+
+@instrumented
+def get_change_seq():
+    with get_db() as conn:
+        return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM message_changes").fetchone()[0]
+
+# Changes to one conversation after seq, as [(seq, message_id, kind)] oldest first.
+# Returns None when changes after seq have already been pruned and the caller must reload.
+@instrumented
+def get_changes_since(seq, conversation_id):
+    with get_db() as conn:
+        oldest = conn.execute("SELECT MIN(seq) FROM message_changes").fetchone()[0]
+        if oldest is not None and oldest > seq + 1:
+            return None
+        return conn.execute(
+            "SELECT seq, message_id, kind FROM message_changes WHERE conversation_id = ? AND seq > ? ORDER BY seq",
+            (conversation_id, seq),
+        ).fetchall()
+
+# Indexed token naming a conversation in the search index. Conversation ids are JSON, which the
+# tokenizer would split into member names, so a hash of the id is indexed instead.
+def search_scope(conversation_id):
+    return "s" + hashlib.sha256(conversation_id.encode("utf-8")).hexdigest()[:24]
+
+def index_message_content(conn, message_id, content, conversation_id, search_rowid=None):
+    if search_rowid is not None:
+        conn.execute("DELETE FROM messages_fts WHERE rowid = ?", (search_rowid,))
+    cur = conn.execute(
+        "INSERT INTO messages_fts (content, scope, message_id, conversation_id) VALUES (?, ?, ?, ?)",
+        (content, search_scope(conversation_id), message_id, conversation_id),
+    )
+    conn.execute("UPDATE messages SET search_rowid = ? WHERE id = ?", (cur.lastrowid, message_id))
+
+@instrumented
+def update_message_content(message_id, new_content):
+    def write(conn):
+        row = conn.execute("SELECT conversation_id, search_rowid FROM messages WHERE id = ?", (message_id,)).fetchone()
+        if row is None:
+            return None
+        conversation_id, search_rowid = row
+        conn.execute("""
+            UPDATE messages SET content=?, content_version = content_version + 1 WHERE id=?
+        """, (new_content, message_id))
+        index_message_content(conn, message_id, new_content, conversation_id, search_rowid)
+        return record_change(conn, conversation_id, message_id, "edit")
+
+    publish_change(run_write(write))
+
+MESSAGE_COLUMNS = (
+    "id, username, timestamp, type, content, file_path, recipient, reply_to, like_count, "
+    "file_name, file_size, mime_type, content_version, like_version"
+)
+# Columns of the replied-to message, read through "LEFT JOIN messages parent ON parent.id = <row>.reply_to"
+REPLY_PREVIEW_COLUMNS = f"parent.username, parent.type, substr(parent.content, 1, {REPLY_PREVIEW_CHARS + 1})"
+
+def make_reply_preview(r_user, r_type, r_content):
+    if r_user is None:
+        return None
+    if r_content and len(r_content) > REPLY_PREVIEW_CHARS:
+        r_content = r_content[:REPLY_PREVIEW_CHARS] + "…"
+    return r_user, r_type, r_content
+
+# Splits the trailing REPLY_PREVIEW_COLUMNS off each row into a (username, type, snippet) preview or None
+def with_reply_previews(rows):
+    cache = get_reply_preview_cache()
+    messages = []
+    for row in rows:
+        preview = make_reply_preview(*row[-3:])
+        if preview:
+            cache.put(row[7], preview)
+        messages.append(tuple(row[:-3]) + (preview,))
+    return messages
+
+# Looks in the conversation's archives too when given its id (the parent may have been archived)
+def load_reply_preview(conn, msg_id, conversation_id=None):
+    columns = f"username, type, substr(content, 1, {REPLY_PREVIEW_CHARS + 1})"
+    row = conn.execute(f"SELECT {columns} FROM messages WHERE id = ?", (msg_id,)).fetchone()
+    if row is None and conversation_id:
+        row = find_archived_message(conn, conversation_id, msg_id, columns)
+    preview = make_reply_preview(*row) if row else None
+    if preview:
+        get_reply_preview_cache().put(msg_id, preview)
+    return preview
+
+@instrumented
+def get_reply_preview(msg_id, conversation_id=None):
+    preview = get_reply_preview_cache().get(msg_id)
+    if preview is None:
+        with get_db() as conn:
+            preview = load_reply_preview(conn, msg_id, conversation_id)
+    return preview
+
+# Fills in previews of replies whose parent is stored in another database (hot vs. archive)
+def with_cross_database_previews(conn, conversation_id, messages):
+    return [
+        m[:-1] + (get_reply_preview_cache().get(m[7]) or load_reply_preview(conn, m[7], conversation_id),)
+        if m[7] and m[-1] is None else m
+        for m in messages
+    ]
+
+# (ts, id, archive month or None) of a message in the conversation, or None if it does not exist
+def get_message_sort_key(conn, msg_id, conversation_id):
+    row = conn.execute("SELECT ts, id FROM messages WHERE id = ?", (msg_id,)).fetchone()
+    if row is not None:
+        return row[0], row[1], None
+    row = find_archived_message(conn, conversation_id, msg_id, "ts, id")
+    return (row[0], row[1], month_of(row[0])) if row else None
+
+def page_rows(conn, schema, conversation_id, keyset_sql, keyset_params, order_sql, limit):
+    columns = ", ".join(f"m.{col}" for col in MESSAGE_COLUMNS.split(", "))
+    return conn.execute(f"""
+        SELECT {columns}, {REPLY_PREVIEW_COLUMNS}
+        FROM {schema}.messages m LEFT JOIN {schema}.messages parent ON parent.id = m.reply_to
+        WHERE m.conversation_id = ?{keyset_sql}
+        ORDER BY {order_sql}
+        LIMIT ?
+    """, (conversation_id, *keyset_params, limit)).fetchall()
+
+def get_conversation_total(conn, conversation_id):
+    row = conn.execute("SELECT total FROM conversation_counts WHERE conversation_id = ?", (conversation_id,)).fetchone()
+    return row[0] if row else 0
+
+# Returns one page of a conversation, oldest first, as (messages, total_count, has_older, has_newer).
+# Pages are addressed by message id cursors; with neither before nor after set the newest page is returned.
+# Each message row ends with its reply preview (see with_reply_previews).
+# Archived messages are older than every hot one and each archive covers one month, so a page
+# continues from the hot table into the conversation's archives (or back) in time order.
+@instrumented
+def get_messages(current_user, chat_with=None, before=None, after=None, page_size=20):
+    conversation_id = conversation_key(current_user, chat_with)
+    with get_db() as conn:
+        descending = after is None
+        cursor_id = before or after
+        cursor_key = get_message_sort_key(conn, cursor_id, conversation_id) if cursor_id else None
+        cursor_month = None
+        if cursor_key is None:
+            descending, cursor_id = True, None
+            keyset_sql, keyset_params = "", ()
+        else:
+            keyset_sql = " AND (m.ts, m.id) < (?, ?)" if descending else " AND (m.ts, m.id) > (?, ?)"
+            keyset_params = tuple(cursor_key[:2])
+            cursor_month = cursor_key[2]
+        order_sql = "m.ts DESC, m.id DESC" if descending else "m.ts ASC, m.id ASC"
+
+        months = get_archive_months(conn, conversation_id)
+        if descending:
+            sources = ([None] if cursor_month is None else []) + [
+                month for month in months if cursor_month is None or month <= cursor_month
+            ]
+        else:
+            sources = [month for month in reversed(months) if cursor_month and month >= cursor_month] + [None]
+        rows = []
+        for month in sources:
+            if len(rows) > page_size:
+                break
+            if month is None:
+                rows += page_rows(conn, "main", conversation_id, keyset_sql, keyset_params, order_sql,
+                                  page_size + 1 - len(rows))
+            else:
+                with attached_archive(conn, month):
+                    rows += page_rows(conn, "archive", conversation_id, keyset_sql, keyset_params, order_sql,
+                                      page_size + 1 - len(rows))
+        messages = with_reply_previews(rows)
+        has_more = len(messages) > page_size
+        messages = messages[:page_size]
+        if months:
+            messages = with_cross_database_previews(conn, conversation_id, messages)
+        if descending:
+            messages.reverse()
+            has_older, has_newer = has_more, cursor_id is not None
+        else:
+            has_older, has_newer = True, has_more
+        total_count = get_conversation_total(conn, conversation_id)
+
+    return messages, total_count, has_older, has_newer
+
+def fts_query(search_text, conversation_id):
+    # Every word becomes a quoted prefix term, so user input can never be parsed as FTS5 syntax
+    terms = re.findall(r"\w+", search_text)
+    if not terms:
+        return None
+    words = " ".join(f'"{term}"*' for term in terms)
+    return f'scope : "{search_scope(conversation_id)}" AND content : ({words})'
+# Ranked full-text search within one conversation, as (messages, total_count, snippets by message id)
+@instrumented
+def search_messages(current_user, chat_with=None, search_text="", page=1, page_size=20):
+    conversation_id = conversation_key(current_user, chat_with)
+    match = fts_query(search_text, conversation_id)
+    if not match:
+        return [], 0, {}
+    offset = (page - 1) * page_size
+    rows, total_count = [], 0
+    with get_db() as conn:
+        # Hot matches rank first, then each archive's from newest to oldest
+        months = get_archive_months(conn, conversation_id)
+        for month in [None] + months:
+            if total_count >= SEARCH_COUNT_LIMIT:
+                break
+            if month is None:
+                count, found = search_rows(conn, "main", match, conversation_id, total_count, offset, page_size, rows)
+            else:
+                with attached_archive(conn, month):
+                    count, found = search_rows(
+                        conn, "archive", match, conversation_id, total_count, offset, page_size, rows
+                    )
+            rows += found
+            total_count += count
+        messages = with_reply_previews([row[:-1] for row in rows])
+        if months:
+            messages = with_cross_database_previews(conn, conversation_id, messages)
+    snippets = {row[0]: row[-1] for row in rows}
+    return messages, total_count, snippets
+
+# Matches in one database, as (match count, rows of the requested page that fall in this database);
+# `preceding` matches come from databases searched before it. Counting stops at SEARCH_COUNT_LIMIT.
+def search_rows(conn, schema, match, conversation_id, preceding, offset, page_size, rows_so_far):
+    count = conn.execute(f"""
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM {schema}.messages_fts WHERE messages_fts MATCH ? AND conversation_id = ? LIMIT ?
+        )
+    """, (match, conversation_id, SEARCH_COUNT_LIMIT - preceding)).fetchone()[0]
+    wanted = page_size - len(rows_so_far)
+    start = offset + len(rows_so_far) - preceding
+    if wanted <= 0 or start >= count:
+        return count, []
+    columns = ", ".join(f"m.{col}" for col in MESSAGE_COLUMNS.split(", "))
+    found = conn.execute(f"""
+        SELECT {columns}, {REPLY_PREVIEW_COLUMNS}, snippet(messages_fts, 0, '**', '**', '…', 16)
+        FROM {schema}.messages_fts
+        JOIN {schema}.messages m ON m.id = messages_fts.message_id
+        LEFT JOIN {schema}.messages parent ON parent.id = m.reply_to
+        WHERE messages_fts MATCH ? AND messages_fts.conversation_id = ?
+        ORDER BY messages_fts.rank
+        LIMIT ? OFFSET ?
+    """, (match, conversation_id, wanted, start)).fetchall()
+    return count, found
+
+# Full page rows (including reply previews) for specific messages, oldest first
+@instrumented
+def get_messages_by_ids(message_ids):
+    if not message_ids:
+        return []
+    placeholders = ", ".join("?" * len(message_ids))
+    columns = ", ".join(f"m.{col}" for col in MESSAGE_COLUMNS.split(", "))
+    with get_db() as conn:
+        rows = conn.execute(f"""
+            SELECT {columns}, {REPLY_PREVIEW_COLUMNS}
+            FROM messages m LEFT JOIN messages parent ON parent.id = m.reply_to
+            WHERE m.id IN ({placeholders})
+            ORDER BY m.ts, m.id
+        """, tuple(message_ids)).fetchall()
+    return with_reply_previews(rows)
+
+# The given ids that are not in the hot table; archived messages are read-only (no likes or edits)
+@instrumented
+def get_archived_message_ids(message_ids):
+    if not message_ids:
+        return set()
+    placeholders = ", ".join("?" * len(message_ids))
+    with get_db() as conn:
+        rows = conn.execute(f"SELECT id FROM messages WHERE id IN ({placeholders})", tuple(message_ids)).fetchall()
+    return set(message_ids) - {row[0] for row in rows}
+
+@instrumented
+def get_message_by_id(msg_id):
+    with get_db() as conn:
+        return conn.execute(f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE id = ?", (msg_id,)).fetchone()
+
+# Presence registry: online lists are served from memory and last-seen writes are coalesced
+class PresenceRegistry:
+    def __init__(self):
+        self._last_seen = {}  # username -> epoch ms
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._last_sync = None
+
+    # Other processes are told at most once per PRESENCE_FLUSH_SECONDS per user, sessions here and
+    # there only when the user was not already online
+    def touch(self, username):
+        now_ms = int(time.time() * 1000)
+        with self._lock:
+            previous = self._last_seen.get(username, 0)
+            self._last_seen[username] = now_ms
+            self._dirty.add(username)
+        if now_ms - previous >= PRESENCE_FLUSH_SECONDS * 1000:
+            event = {"username": username, "ms": now_ms}
+            notifier = get_notifier()
+            if notifier is not None:
+                notifier.broadcast(PRESENCE_TOPIC, event)
+            if now_ms - previous >= ONLINE_TIMEOUT_SECONDS * 1000:
+                get_broker().publish(PRESENCE_TOPIC, event)
+        if time.monotonic() - self._last_flush >= PRESENCE_FLUSH_SECONDS:
+            self.flush()
+
+    # Last-seen time announced by another process; that process writes it to SQLite
+    def merge(self, username, ms):
+        with self._lock:
+            previous = self._last_seen.get(username, 0)
+            if ms > previous:
+                self._last_seen[username] = ms
+        if ms - previous >= ONLINE_TIMEOUT_SECONDS * 1000:
+            get_broker().publish(PRESENCE_TOPIC, {"username": username, "ms": ms})
+
+    def flush(self):
+        with self._lock:
+            batch = [(name, self._last_seen[name]) for name in self._dirty]
+            self._dirty.clear()
+            self._last_flush = time.monotonic()
+        if not batch:
+            return
+        rows = [
+            (name, datetime.fromtimestamp(ms / 1000, timezone.utc).isoformat(), ms)
+            for name, ms in batch
+        ]
+
+        def write(conn):
+            conn.executemany("""
+                INSERT INTO users_online(username, last_seen, last_seen_ms) VALUES (?, ?, ?)
+                ON CONFLICT(username) DO UPDATE SET last_seen=excluded.last_seen, last_seen_ms=excluded.last_seen_ms
+                WHERE excluded.last_seen_ms > users_online.last_seen_ms
+            """, rows)
+
+        try:
+            run_write(write)
+        except sqlite3.Error:
+            with self._lock:
+                self._dirty.update(name for name, _ in batch)
+            raise
+
+    # Merge in users recently seen by other processes (cold path, uses the last_seen_ms index)
+    def sync(self):
+        now_ms = int(time.time() * 1000)
+        with get_db() as conn:
+            rows = conn.execute(
+                "SELECT username, last_seen_ms FROM users_online WHERE last_seen_ms > ?",
+                (now_ms - PRESENCE_MEMORY_SECONDS * 1000,),
+            ).fetchall()
+        with self._lock:
+            for name, ms in rows:
+                if ms > self._last_seen.get(name, 0):
+                    self._last_seen[name] = ms
+            for name in [n for n, ms in self._last_seen.items() if ms <= now_ms - PRESENCE_MEMORY_SECONDS * 1000]:
+                if name not in self._dirty:
+                    del self._last_seen[name]
+            self._last_sync = time.monotonic()
+
+    def online(self, timeout_seconds):
+        if self._last_sync is None or time.monotonic() - self._last_sync >= PRESENCE_SYNC_SECONDS:
+            self.sync()
+        threshold_ms = int(time.time() * 1000) - timeout_seconds * 1000
+        with self._lock:
+            return sorted(name for name, ms in self._last_seen.items() if ms > threshold_ms)
+
+@process_singleton
+def get_presence():
+    registry = PresenceRegistry()
+    atexit.register(registry.flush)
+    return registry
+
+@instrumented
+def update_user_last_seen(username):
+    get_presence().touch(username)
+
+@instrumented
+def get_online_users(timeout_seconds=ONLINE_TIMEOUT_SECONDS):
+    return get_presence().online(timeout_seconds)
+
+@instrumented
+def get_likes_for_message(message_id):
+    return get_likes_for_messages([message_id])[message_id]
+
+# Like sets for a whole page of messages in one query, keyed by message id. With the conversation id,
+# messages without hot likes are also looked up in the conversation's archives.
+@instrumented
+def get_likes_for_messages(message_ids, conversation_id=None):
+    likes = {message_id: set() for message_id in message_ids}
+    if not likes:
+        return likes
+    placeholders = ", ".join("?" * len(likes))
+    with get_db() as conn:
+        rows = conn.execute(
+            f"SELECT message_id, username FROM message_likes WHERE message_id IN ({placeholders})",
+            tuple(likes),
+        ).fetchall()
+        for message_id, username in rows:
+            likes[message_id].add(username)
+        missing = [message_id for message_id, users in likes.items() if not users]
+        for month in get_archive_months(conn, conversation_id) if missing and conversation_id else []:
+            with attached_archive(conn, month):
+                rows = conn.execute(
+                    f"SELECT message_id, username FROM archive.message_likes "
+                    f"WHERE message_id IN ({', '.join('?' * len(missing))})",
+                    missing,
+                ).fetchall()
+            for message_id, username in rows:
+                likes[message_id].add(username)
+            missing = [message_id for message_id in missing if not likes[message_id]]
+            if not missing:
+                break
+    return likes
+
+@instrumented
+def user_liked_message(username, message_id):
+    with get_db() as conn:
+        row = conn.execute("SELECT 1 FROM message_likes WHERE message_id = ? AND username = ?", (message_id, username)).fetchone()
+    return row is not None
+
+@instrumented
+def add_like(username, message_id):
+    def write(conn):
+        row = conn.execute("SELECT conversation_id FROM messages WHERE id = ?", (message_id,)).fetchone()
+        if row is None:
+            return None  # archived (read-only) or unknown message
+        cur = conn.execute("INSERT OR IGNORE INTO message_likes (message_id, username) VALUES (?, ?)", (message_id, username))
+        if not cur.rowcount:
+            return None
+        conn.execute(
+            "UPDATE messages SET like_count = like_count + 1, like_version = like_version + 1 WHERE id = ?",
+            (message_id,),
+        )
+        return record_change(conn, row[0], message_id, "like")
+
+    publish_change(run_write(write))
+
+@instrumented
+def remove_like(username, message_id):
+    def write(conn):
+        cur = conn.execute("DELETE FROM message_likes WHERE message_id = ? AND username = ?", (message_id, username))
+        if not cur.rowcount:
+            return None
+        row = conn.execute(
+            "UPDATE messages SET like_count = like_count - 1, like_version = like_version + 1 WHERE id = ? RETURNING conversation_id",
+            (message_id,),
+        ).fetchone()
+        return record_change(conn, row[0], message_id, "like") if row else None
+
+    publish_change(run_write(write))
@@ -1,248 +1,184 @@
 import streamlit as st
-import sqlite3
+import functools
+import json
 import os
-import uuid
-from datetime import datetime, timezone, timedelta
-from streamlit_autorefresh import st_autorefresh
-import hashlib
+import time
+from datetime import datetime
+from chatstore import (
+    PRESENCE_TOPIC,
+    SEARCH_COUNT_LIMIT,
+    SESSION_TTL_SECONDS,
+    LRUCache,
+    add_like,
+    begin_rerun_trace,
+    conversation_key,
+    create_session,
+    end_session,
+    end_rerun_trace,
+    format_file_size,
+    get_archived_message_ids,
+    get_broker,
+    get_change_seq,
+    get_changes_since,
+    get_likes_for_messages,
+    get_messages,
+    get_messages_by_ids,
+    get_metrics,
+    get_notifier,
+    get_online_users,
+    get_reply_preview,
+    get_thumbnail,
+    get_unread_counts,
+    get_user_pin_hash,
+    init_db,
+    mark_conversation_read,
+    read_upload,
+    register_user_pin,
+    remove_like,
+    resolve_file_path,
+    resume_session,
+    save_message,
+    search_messages,
+    start_archiver,
+    start_thumbnail_backfill,
+    submit_pin_task,
+    update_message_content,
+    update_user_last_seen,
+    user_topic,
+    verify_pin,
+)
 
 # --- CONFIGURATION ---
-DB_NAME = "chat.db"
-UPLOAD_FOLDER = "uploads"
+# Storage, archival and metrics export settings live in chatstore.py
 NOTIFICATION_SOUND = "notification_ding.mp3"  # Update with your path or URL as needed
 
-# --- DATABASE SETUP ---
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    # Messages table with reply_to
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id TEXT PRIMARY KEY,
-            username TEXT NOT NULL,
-            recipient TEXT,
-            timestamp TEXT NOT NULL,
-            type TEXT NOT NULL,
-            content TEXT,
-            file_path TEXT,
-            reply_to TEXT
-        )
-    """)
-    # Online users
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users_online (
-            username TEXT PRIMARY KEY,
-            last_seen TEXT NOT NULL
-        )
-    """)
-    # User PINs for login
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS user_pins (
-            username TEXT PRIMARY KEY,
-            pin_hash TEXT NOT NULL
-        )
-    """)
-    # Likes table
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS message_likes (
-            message_id TEXT NOT NULL,
-            username TEXT NOT NULL,
-            PRIMARY KEY (message_id, username),
-            FOREIGN KEY (message_id) REFERENCES messages(id),
-            FOREIGN KEY (username) REFERENCES user_pins(username)
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-def hash_pin(pin):
-    return hashlib.sha256(pin.encode("utf-8")).hexdigest()
-
-def register_user_pin(username, pin):
-    pin_hash = hash_pin(pin)
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO user_pins (username, pin_hash) VALUES (?, ?)
-        ON CONFLICT(username) DO UPDATE SET pin_hash=excluded.pin_hash
-    """, (username, pin_hash))
-    conn.commit()
-    conn.close()
-
-def get_user_pin_hash(username):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT pin_hash FROM user_pins WHERE username = ?", (username,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else None
-
-def verify_pin(username, pin):
-    stored_hash = get_user_pin_hash(username)
-    if not stored_hash:
-        return False
-    return stored_hash == hash_pin(pin)
-
-def save_message(username, msg_type, content=None, file_bytes=None, file_name=None, recipient=None, reply_to=None):
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-    file_path = None
-    msg_id = str(uuid.uuid4())
-    timestamp = datetime.now(timezone.utc).isoformat()
-    if file_bytes and file_name:
-        file_path = os.path.join(UPLOAD_FOLDER, f"{msg_id}_{file_name}")
-        with open(file_path, "wb") as f:
-            f.write(file_bytes)
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO messages (id, username, recipient, timestamp, type, content, file_path, reply_to)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (msg_id, username, recipient, timestamp, msg_type, content, file_path, reply_to))
-    conn.commit()
-    conn.close()
-
-def update_message_content(message_id, new_content):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("""
-        UPDATE messages SET content=? WHERE id=?
-    """, (new_content, message_id))
-    conn.commit()
-    conn.close()
-
-def get_messages(current_user, chat_with=None, search_text=None, page=1, page_size=20):
-    offset = (page - 1) * page_size
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    base_query = """
-        SELECT id, username, timestamp, type, content, file_path, recipient, reply_to
-        FROM messages
-    """
-    params = []
-    where_clauses = []
-
-    if chat_with:
-        where_clauses.append(
-            "((username = ? AND recipient = ?) OR (username = ? AND recipient = ?))"
-        )
-        params.extend([current_user, chat_with, chat_with, current_user])
-    else:
-        where_clauses.append("(recipient IS NULL OR recipient = '')")
-
-    if search_text:
-        where_clauses.append("LOWER(content) LIKE ?")
-        params.append(f"%{search_text.lower()}%")
-
-    where_sql = " WHERE " + " AND ".join(where_clauses) if where_clauses else ""
-    query = f"{base_query} {where_sql} ORDER BY timestamp ASC LIMIT ? OFFSET ?"
-    params.extend([page_size, offset])
-
-    c.execute(query, tuple(params))
-    messages = c.fetchall()
-
-    count_query = f"SELECT COUNT(*) FROM messages {where_sql}"
-    count_params = tuple(params[:-2])
-    c.execute(count_query, count_params)
-    total_count = c.fetchone()[0]
-
-    conn.close()
-    return messages, total_count
-
-def get_message_by_id(msg_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("""
-        SELECT id, username, timestamp, type, content, file_path, recipient, reply_to
-        FROM messages WHERE id = ?
-    """, (msg_id,))
-    msg = c.fetchone()
-    conn.close()
-    return msg
-
-def update_user_last_seen(username):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    now_iso = datetime.now(timezone.utc).isoformat()
-    c.execute("""
-        INSERT INTO users_online(username, last_seen) VALUES (?, ?)
-        ON CONFLICT(username) DO UPDATE SET last_seen=excluded.last_seen
-    """, (username, now_iso))
-    conn.commit()
-    conn.close()
-
-def get_online_users(timeout_seconds=120):
-    threshold_time = datetime.now(timezone.utc) - timedelta(seconds=timeout_seconds)
-    threshold_iso = threshold_time.isoformat()
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT username FROM users_online WHERE last_seen > ?", (threshold_iso,))
-    rows = c.fetchall()
-    conn.close()
-    return [r[0] for r in rows]
-
-def get_likes_for_message(message_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT username FROM message_likes WHERE message_id = ?", (message_id,))
-    rows = c.fetchall()
-    conn.close()
-    return set([row[0] for row in rows])
-
-def user_liked_message(username, message_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM message_likes WHERE message_id = ? AND username = ?", (message_id, username))
-    liked = c.fetchone() is not None
-    conn.close()
-    return liked
-
-def add_like(username, message_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    try:
-        c.execute("INSERT OR IGNORE INTO message_likes (message_id, username) VALUES (?, ?)", (message_id, username))
-        conn.commit()
-    finally:
-        conn.close()
-
-def remove_like(username, message_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("DELETE FROM message_likes WHERE message_id = ? AND username = ?", (message_id, username))
-    conn.commit()
-    conn.close()
+# Prepared chat bubbles, reused across reruns until the message's content or likes change
+RENDER_CACHE_SIZE = 4096
+
+# Live updates: events pushed by this and the other server processes are picked up within
+# LIVE_CHECK_SECONDS; the change feed is also polled every FALLBACK_POLL_SECONDS in case a
+# cross-process notification was lost or notifications are unavailable
+LIVE_CHECK_SECONDS = 0.5
+FALLBACK_POLL_SECONDS = 10
+PRESENCE_REFRESH_SECONDS = 30
+
+# Login: the session token is kept in the SESSION_COOKIE cookie (never in the URL, which gets shared),
+# and a PIN being checked in the background is polled every PIN_CHECK_POLL_SECONDS
+SESSION_COOKIE = "privatechat_session"
+PIN_CHECK_POLL_SECONDS = 0.25
+
+# Users listed in PRIVATECHAT_ADMINS (comma separated) get a performance panel in the sidebar
+METRICS_ADMINS = {name.strip() for name in os.environ.get("PRIVATECHAT_ADMINS", "").split(",") if name.strip()}
+
+# --- CACHES ---
+@st.cache_resource
+def get_render_cache():
+    return LRUCache(RENDER_CACHE_SIZE)
+
+# --- SESSION COOKIE ---
+# st.context.cookies is read-only and only holds the cookies sent when the session connected, so the
+# cookie is written from a script in an empty iframe (JavaScript cannot set HttpOnly)
+def write_session_cookie(token):
+    max_age = SESSION_TTL_SECONDS if token else 0
+    cookie = json.dumps(f"{SESSION_COOKIE}={token}; Path=/; Max-Age={max_age}; SameSite=Strict")
+    st.iframe(f"""<script>
+        const secure = window.parent.location.protocol === "https:" ? "; Secure" : "";
+        window.parent.document.cookie = {cookie} + secure;
+    </script>""", height="content")
 
 # --- SESSION STATE INIT ---
 if "username" not in st.session_state:
     st.session_state.username = None
 if "authenticated" not in st.session_state:
     st.session_state.authenticated = False
-if "page" not in st.session_state:
-    st.session_state.page = 1
+if "session_token" not in st.session_state:
+    st.session_state.session_token = None
+if "session_resume_tried" not in st.session_state:
+    st.session_state.session_resume_tried = False
+if "cookie_update" not in st.session_state:
+    st.session_state.cookie_update = None  # token to store in the session cookie, "" to clear it
+if "pin_task" not in st.session_state:
+    st.session_state.pin_task = None  # ("login" | "register", username, Future) while a PIN is being hashed
+if "page_cursor" not in st.session_state:
+    st.session_state.page_cursor = None  # None for the newest page, else ("before" | "after", message id)
+if "page_chat" not in st.session_state:
+    st.session_state.page_chat = None
 if "page_size" not in st.session_state:
     st.session_state.page_size = 20
 if "search_text" not in st.session_state:
     st.session_state.search_text = ""
+if "search_page" not in st.session_state:
+    st.session_state.search_page = 1
 if "reply_to" not in st.session_state:
     st.session_state.reply_to = None
-if "last_global_msg_count" not in st.session_state:
-    st.session_state.last_global_msg_count = 0
-if "last_private_msg_count" not in st.session_state:
-    st.session_state.last_private_msg_count = {}
+if "last_unread" not in st.session_state:
+    st.session_state.last_unread = {}  # conversation id -> unread count notified about
 if "edit_message_id" not in st.session_state:
     st.session_state.edit_message_id = None
 if "edit_message_content" not in st.session_state:
     st.session_state.edit_message_content = ""
+if "show_original_images" not in st.session_state:
+    st.session_state.show_original_images = set()
 
 # --- APP START ---
 
 init_db()
+start_thumbnail_backfill()
+start_archiver()
+get_notifier()  # listen for other server processes' changes from the first run on
 st.set_page_config(page_title="Secure Persistent Chat - Edit Feature", layout="wide")
 st.title("🔒 Secure Persistent Chat with Message Editing, Likes, and PIN Access")
 
-st_autorefresh(interval=5000, limit=None, key="refresh")
+# Instrumentation for this rerun (see RerunTrace)
+rerun_trace = begin_rerun_trace(st.session_state.username, st.session_state.get("rerun_trace"))
+st.session_state.rerun_trace = rerun_trace
+rerun_trace.phase("auth")
+
+# RESUME SESSION FROM THE COOKIE (reloads, reconnects and server restarts), once per browser session
+if st.session_state.cookie_update is not None:
+    write_session_cookie(st.session_state.cookie_update)
+    st.session_state.cookie_update = None
+if not st.session_state.session_resume_tried:
+    st.session_state.session_resume_tried = True
+    cookie_token = st.context.cookies.get(SESSION_COOKIE)
+    if cookie_token:
+        resumed_user = resume_session(cookie_token)
+        if resumed_user:
+            st.session_state.username = resumed_user
+            st.session_state.authenticated = True
+            st.session_state.session_token = cookie_token
+        else:
+            write_session_cookie("")
 
 # LOGIN WITH PIN
+@st.fragment(run_every=PIN_CHECK_POLL_SECONDS)
+def pin_task_status():
+    if st.session_state.pin_task[2].done():
+        st.rerun()
+    st.info("Checking PIN…")
+
+# Outcome of a finished background PIN check or registration
+pin_task = st.session_state.pin_task
+if pin_task is not None and pin_task[2].done():
+    st.session_state.pin_task = None
+    task_kind, task_user, task_future = pin_task
+    if task_user == st.session_state.username:
+        try:
+            task_result = task_future.result()
+        except Exception:
+            st.error("The PIN could not be checked. Please try again.")
+        else:
+            if task_kind == "register":
+                st.success("PIN registered successfully! Please log in with your PIN.")
+            elif task_result:
+                token = create_session(task_user)
+                st.session_state.session_token = token
+                st.session_state.authenticated = True
+                st.session_state.cookie_update = token
+                st.rerun()
+            else:
+                st.error("Incorrect PIN. Try again.")
+
 if not st.session_state.username:
     username_input = st.text_input("Enter your username:")
     if st.button("Next") and username_input.strip():
@@ -252,6 +188,9 @@ if not st.session_state.username:
         st.stop()
 
 if st.session_state.username and not st.session_state.authenticated:
+    if st.session_state.pin_task is not None:
+        pin_task_status()
+        st.stop()
     stored_pin_hash = get_user_pin_hash(st.session_state.username)
     if stored_pin_hash is None:
         st.markdown("**New user detected. Please register by setting a PIN.**")
@@ -259,8 +198,8 @@ if st.session_state.username and not st.session_state.authenticated:
         pin2 = st.text_input("Confirm PIN", type="password")
         if pin1 and pin2 and st.button("Register PIN"):
             if pin1 == pin2:
-                register_user_pin(st.session_state.username, pin1)
-                st.success("PIN registered successfully! Please log in with your PIN.")
+                future = submit_pin_task(register_user_pin, st.session_state.username, pin1)
+                st.session_state.pin_task = ("register", st.session_state.username, future)
                 st.rerun()
             else:
                 st.error("PINs do not match. Try again.")
@@ -268,15 +207,22 @@ if st.session_state.username and not st.session_state.authenticated:
     else:
         pin_input = st.text_input(f"Enter PIN for {st.session_state.username}", type="password")
         if pin_input and st.button("Login"):
-            if verify_pin(st.session_state.username, pin_input):
-                st.session_state.authenticated = True
-                st.success("Login successful!")
-                st.rerun()
-            else:
-                st.error("Incorrect PIN. Try again.")
+            future = submit_pin_task(verify_pin, st.session_state.username, pin_input)
+            st.session_state.pin_task = ("login", st.session_state.username, future)
+            st.rerun()
         st.stop()
 
 # USER AUTHENTICATED FROM HERE
+rerun_trace.phase("sidebar")
+
+if st.sidebar.button("Log out"):
+    if st.session_state.session_token:
+        end_session(st.session_state.session_token)
+    st.session_state.cookie_update = ""
+    st.session_state.username = None
+    st.session_state.authenticated = False
+    st.session_state.session_token = None
+    st.rerun()
 
 update_user_last_seen(st.session_state.username)
 
@@ -290,10 +236,57 @@ if online_users:
 else:
     st.sidebar.markdown("_No users online_")
 
+# Unread badges for every conversation; private chats with unread messages are listed even when offline
+unread_counts = get_unread_counts(st.session_state.username)
+unread_by_user = {other: unread for other, unread in unread_counts.values() if unread}
+unread_box = st.sidebar.container()
+
 private_chat_users = [u for u in online_users if u != st.session_state.username]
+private_chat_users += sorted(other for other in unread_by_user if other and other not in private_chat_users)
 
 chat_target = st.sidebar.selectbox("Select Chat Target", ["Global Chat"] + private_chat_users)
 active_chat_user = None if chat_target == "Global Chat" else chat_target
+if active_chat_user != st.session_state.page_chat:
+    st.session_state.page_chat = active_chat_user
+    st.session_state.page_cursor = None
+    st.session_state.search_page = 1
+
+# The open chat is not badged when its newest page is about to be shown (which marks it read)
+if not st.session_state.page_cursor and not st.session_state.search_text.strip():
+    unread_by_user.pop(active_chat_user, None)
+if unread_by_user:
+    unread_box.markdown("### 📬 Unread")
+    for other, unread in sorted(unread_by_user.items(), key=lambda item: (item[0] is not None, item[0] or "")):
+        unread_box.markdown(f"**{other or 'Global Chat'}** · {unread} new")
+
+# Live updates: subscribe to the user's conversations, to new messages addressed to them (including the
+# first message of a new private chat) and to users coming online, and let a lightweight fragment
+# trigger a full rerun only when something relevant was published (or found by the fallback poll)
+live_topic = conversation_key(st.session_state.username, active_chat_user)
+live_topics = set(unread_counts) | {live_topic, "global", user_topic(st.session_state.username), PRESENCE_TOPIC}
+subscription = st.session_state.get("live_subscription")
+if subscription is None or subscription.topics != live_topics:
+    if subscription is not None:
+        get_broker().unsubscribe(subscription)
+    subscription = get_broker().subscribe(live_topics)
+    st.session_state.live_subscription = subscription
+subscription.drain()  # this run already reflects everything published so far
+st.session_state.live_seen_seq = get_change_seq()
+st.session_state.live_last_run = st.session_state.live_last_poll = time.monotonic()
+
+@st.fragment(run_every=LIVE_CHECK_SECONDS)
+def live_updates(topic):
+    now = time.monotonic()
+    if st.session_state.live_subscription.drain():
+        st.rerun()
+    if now - st.session_state.live_last_run >= PRESENCE_REFRESH_SECONDS:
+        st.rerun()
+    if now - st.session_state.live_last_poll >= FALLBACK_POLL_SECONDS:
+        st.session_state.live_last_poll = now
+        if get_changes_since(st.session_state.live_seen_seq, topic) != []:
+            st.rerun()
+
+live_updates(live_topic)
 
 # Pagination and search controls
 page_size = st.sidebar.selectbox(
@@ -302,69 +295,170 @@ page_size = st.sidebar.selectbox(
 )
 if page_size != st.session_state.page_size:
     st.session_state.page_size = page_size
-    st.session_state.page = 1
+    st.session_state.page_cursor = None
+    st.session_state.search_page = 1
 
 search_text = st.sidebar.text_input(
     "Search messages (text only)", value=st.session_state.search_text,
-    help="Search messages in current chat (case-insensitive)",
+    help="Search messages in current chat by word or word prefix, best matches first",
 )
 if search_text != st.session_state.search_text:
     st.session_state.search_text = search_text
-    st.session_state.page = 1
-
+    st.session_state.page_cursor = None
+    st.session_state.search_page = 1
+
+def chat_view_key():
+    conversation_id = conversation_key(st.session_state.username, active_chat_user)
+    return conversation_id, st.session_state.page_cursor, st.session_state.page_size
+
+def load_chat_view():
+    while True:
+        direction, cursor_id = st.session_state.page_cursor or (None, None)
+        # Read the change sequence first so nothing written during the page query is missed
+        seq = get_change_seq()
+        messages, total_count, has_older, has_newer = get_messages(
+            st.session_state.username,
+            active_chat_user,
+            before=cursor_id if direction == "before" else None,
+            after=cursor_id if direction == "after" else None,
+            page_size=st.session_state.page_size,
+        )
+        if not st.session_state.page_cursor or has_newer:
+            break
+        # Paged forward onto the newest messages: show a full latest page instead
+        st.session_state.page_cursor = None
+    return {
+        "key": chat_view_key(),
+        "seq": seq,
+        "messages": messages,
+        "likes": get_likes_for_messages([m[0] for m in messages if m[8]], chat_view_key()[0]),
+        # Archiving does not go through the change feed, so this is only refreshed with the page
+        "archived": get_archived_message_ids([m[0] for m in messages]),
+        "total_count": total_count,
+        "has_older": has_older,
+        "has_newer": has_newer,
+    }
+
+# Applies change-feed entries to the cached page instead of re-running the page query.
+# Returns False when the page has to be reloaded instead.
+def apply_chat_changes(view, changes):
+    page_ids = {m[0] for m in view["messages"]}
+    inserted = [message_id for _, message_id, kind in changes if kind == "insert" and message_id not in page_ids]
+    changed = {message_id for _, message_id, kind in changes if kind != "insert"}
+    # Replies quote their parent, so an edited parent also refreshes its replies on this page
+    stale = {m[0] for m in view["messages"] if m[0] in changed or m[7] in changed}
+    last_id = view["messages"][-1][0] if view["messages"] else None
+
+    # Rows come back in (ts, id) order, so the page's last row shows where the inserts fall
+    fetched = get_messages_by_ids(list(stale | set(inserted) | ({last_id} if inserted and last_id else set())))
+    if inserted and last_id:
+        order = [row[0] for row in fetched]
+        # New messages land after the page; imported history can land inside it
+        if last_id not in order or not set(inserted).isdisjoint(order[:order.index(last_id)]):
+            return False
+    appended = set(inserted) if not view["has_newer"] else set()
+    refreshed = {row[0]: row for row in fetched}
+    messages = [refreshed.get(m[0], m) for m in view["messages"]]
+    messages += [row for row in fetched if row[0] in appended]
+    if len(messages) > st.session_state.page_size:
+        messages = messages[-st.session_state.page_size:]
+        view["has_older"] = True
+
+    for message_id in stale | appended:
+        view["likes"].pop(message_id, None)
+    view["likes"].update(get_likes_for_messages([row[0] for row in fetched if row[8]]))
+    view["messages"] = messages
+    view["total_count"] += len(set(inserted))
+    view["seq"] = changes[-1][0]
+    return True
+
+rerun_trace.phase("get_messages")
+search_snippets = {}
 prev_col, page_info_col, next_col = st.sidebar.columns([1, 2, 1])
-with prev_col:
-    if st.button("Previous"):
-        st.session_state.page = max(1, st.session_state.page - 1)
-
-messages, total_count = get_messages(
-    st.session_state.username,
-    active_chat_user,
-    search_text=st.session_state.search_text.strip() or None,
-    page=st.session_state.page,
-    page_size=st.session_state.page_size,
-)
+if st.session_state.search_text.strip():
+    messages, total_count, search_snippets = search_messages(
+        st.session_state.username,
+        active_chat_user,
+        st.session_state.search_text,
+        page=st.session_state.search_page,
+        page_size=st.session_state.page_size,
+    )
+    page_likes = get_likes_for_messages(
+        [m[0] for m in messages if m[8]], conversation_key(st.session_state.username, active_chat_user)
+    )
+    archived_ids = get_archived_message_ids([m[0] for m in messages])
+    total_pages = max(1, (total_count + st.session_state.page_size - 1) // st.session_state.page_size)
 
-total_pages = max(1, (total_count + st.session_state.page_size - 1) // st.session_state.page_size)
+    with prev_col:
+        if st.session_state.search_page > 1 and st.button("Previous"):
+            st.session_state.search_page -= 1
+            st.rerun()
 
-with page_info_col:
-    st.markdown(f"Page {st.session_state.page} of {total_pages}")
-    st.markdown(f"Total messages: {total_count}")
+    with page_info_col:
+        st.markdown(f"Result page {st.session_state.search_page} of {total_pages}")
+        st.markdown(f"Matching messages: {total_count}{'+' if total_count >= SEARCH_COUNT_LIMIT else ''}")
 
-with next_col:
-    if st.session_state.page < total_pages:
-        if st.button("Next"):
-            st.session_state.page = min(total_pages, st.session_state.page + 1)
+    with next_col:
+        if st.session_state.search_page < total_pages and st.button("Next"):
+            st.session_state.search_page += 1
+            st.rerun()
+else:
+    # The current page lives in session state; refreshes only apply what changed since it was loaded
+    view = st.session_state.get("chat_view")
+    if view is None or view["key"] != chat_view_key():
+        view = load_chat_view()
+    else:
+        changes = get_changes_since(view["seq"], view["key"][0])
+        if changes is None:
+            view = load_chat_view()
+        elif changes and not apply_chat_changes(view, changes):
+            view = load_chat_view()
+    st.session_state.chat_view = view
+    messages, total_count, page_likes = view["messages"], view["total_count"], view["likes"]
+    archived_ids = view["archived"]
+    has_older, has_newer = view["has_older"], view["has_newer"]
+
+    with prev_col:
+        if has_older and messages and st.button("Previous"):
+            st.session_state.page_cursor = ("before", messages[0][0])
+            st.rerun()
 
-if search_text and total_count == 0:
-    st.warning(f"No messages found matching '{search_text}'.")
+    with page_info_col:
+        st.markdown("Latest messages" if not has_newer else "Older messages")
+        st.markdown(f"Total messages: {total_count}")
 
-# Notifications
-def count_global_messages(msg_list):
-    return len([msg for msg in msg_list if msg[6] in (None, '')])
+    with next_col:
+        if has_newer and messages and st.button("Next"):
+            st.session_state.page_cursor = ("after", messages[-1][0])
+            st.rerun()
 
-def count_private_messages(msg_list):
-    return len(msg_list)
+if search_text and total_count == 0:
+    st.warning(f"No messages found matching '{search_text}'.")
 
-if active_chat_user is None:
-    global_msg_count = count_global_messages(messages)
-    if global_msg_count > st.session_state.last_global_msg_count:
-        try:
-            st.audio(NOTIFICATION_SOUND)
-        except Exception as e:
-            st.error(f"Notification sound error: {e}")
-        st.toast("New message in Global Chat! 💬")
-        st.session_state.last_global_msg_count = global_msg_count
-else:
-    curr_private_count = count_private_messages(messages)
-    last_count = st.session_state.last_private_msg_count.get(active_chat_user, 0)
-    if curr_private_count > last_count:
-        try:
-            st.audio(NOTIFICATION_SOUND)
-        except Exception as e:
-            st.error(f"Notification sound error: {e}")
-        st.toast(f"New private message from {active_chat_user}! 🔒")
-        st.session_state.last_private_msg_count[active_chat_user] = curr_private_count
+# Notifications: any conversation whose unread count grew since the last run
+new_activity = [
+    other for conversation_id, (other, unread) in unread_counts.items()
+    if unread > st.session_state.last_unread.get(conversation_id, 0)
+]
+if new_activity:
+    try:
+        st.audio(NOTIFICATION_SOUND)
+    except Exception as e:
+        st.error(f"Notification sound error: {e}")
+    for other in new_activity:
+        st.toast("New message in Global Chat! 💬" if other is None else f"New private message from {other}! 🔒")
+st.session_state.last_unread = {conversation_id: unread for conversation_id, (_, unread) in unread_counts.items()}
+
+# Reading the newest page of a conversation marks it read
+if not st.session_state.search_text.strip() and not has_newer:
+    _, active_unread = unread_counts.get(live_topic, (None, 0))
+    if active_unread:
+        conversation_total = mark_conversation_read(st.session_state.username, live_topic, total_count)
+        if conversation_total != total_count:
+            # The cached page is out of step with the conversation (missed or double-counted rows)
+            st.session_state.chat_view = None
+            st.rerun()
+        st.session_state.last_unread[live_topic] = 0
 
 # Find last message by user in current chat (needed for edit)
 last_user_msg_id = None
@@ -375,39 +469,75 @@ for m in reversed(messages):
         break
 
 # Display chat messages with reply, like, and edit
+rerun_trace.phase("message_loop")
 chat_title = "Global Chat" if active_chat_user is None else f"Private Chat with {active_chat_user}"
 st.subheader(f"Chat History - {chat_title}")
 
 if not messages:
     st.info("No messages to display on this page.")
 
+# Everything shown for a message that is the same for every viewer: header, quoted reply and likes.
+# Cached per (message, content version, like version); the quoted reply is part of the key because
+# editing the parent does not change this message's own versions.
+def build_message_display(user, tstamp, like_count, liked_users, reply_preview_row):
+    try:
+        local_dt = datetime.fromisoformat(tstamp)
+        local_dt_str = local_dt.strftime("%Y-%m-%d %H:%M:%S")
+    except Exception:
+        local_dt_str = tstamp
+
+    reply_preview = None
+    if reply_preview_row:
+        r_user, r_type, r_content = reply_preview_row
+        if r_type == "text":
+            reply_preview = f"**{r_user} said:** {r_content}"
+        else:
+            reply_preview = f"**{r_user} sent a {r_type} message**"
+
+    if liked_users:
+        max_show = 5
+        shown_users = list(liked_users)[:max_show]
+        display_names = ", ".join(shown_users)
+        if like_count > max_show:
+            display_names += f", and {like_count - max_show} more"
+        likes_markdown = f"<small>Liked by: {display_names}</small>"
+    else:
+        likes_markdown = "<small>No likes yet</small>"
+
+    return {
+        "header": f"<small><b>{user}</b> · {local_dt_str}</small>",
+        "reply_preview": f"> {reply_preview}" if reply_preview else None,
+        "liked_users": frozenset(liked_users),
+        "likes": likes_markdown,
+    }
+
+render_cache = get_render_cache()
+
 for (
-    msg_id, user, tstamp, msg_type, content, file_path, recipient, reply_to
+    msg_id, user, tstamp, msg_type, content, file_path, recipient, reply_to, like_count,
+    file_name, file_size, mime_type, content_version, like_version, reply_preview_row
 ) in messages:
+    render_key = (msg_id, content_version, like_version, reply_preview_row)
+    display = render_cache.get(render_key)
+    if display is None:
+        display = build_message_display(user, tstamp, like_count, page_likes.get(msg_id, ()), reply_preview_row)
+        render_cache.put(render_key, display)
+
     with st.chat_message("user" if user == st.session_state.username else "assistant"):
         # Username and timestamp
-        try:
-            local_dt = datetime.fromisoformat(tstamp)
-            local_dt_str = local_dt.strftime("%Y-%m-%d %H:%M:%S")
-        except Exception:
-            local_dt_str = tstamp
-        st.markdown(f"<small><b>{user}</b> · {local_dt_str}</small>", unsafe_allow_html=True)
+        st.markdown(display["header"], unsafe_allow_html=True)
+        if msg_id in search_snippets:
+            st.caption(f"🔎 {search_snippets[msg_id]}")
 
         # Reply preview
-        reply_preview = None
-        if reply_to:
-            replied_msg = get_message_by_id(reply_to)
-            if replied_msg:
-                r_id, r_user, r_ts, r_type, r_content, r_file_path, r_recipient, r_reply_to = replied_msg
-                if r_type == "text":
-                    reply_preview = f"**{r_user} said:** {r_content}"
-                else:
-                    reply_preview = f"**{r_user} sent a {r_type} message**"
-        if reply_preview:
-            st.markdown(f"> {reply_preview}", unsafe_allow_html=True)
+        if display["reply_preview"]:
+            st.markdown(display["reply_preview"], unsafe_allow_html=True)
+
+        # Archived messages are read-only: no edit or like controls
+        is_archived = msg_id in archived_ids
 
         # Message Editing Section
-        is_editing_this_msg = (st.session_state.edit_message_id == msg_id)
+        is_editing_this_msg = (st.session_state.edit_message_id == msg_id) and not is_archived
 
         if is_editing_this_msg and msg_type == "text":
             edit_content = st.text_area(
@@ -431,15 +561,31 @@ for (
             if msg_type == "text":
                 st.write(content)
             elif msg_type == "image" and file_path:
-                st.image(file_path)
+                thumbnail = get_thumbnail(file_path)
+                if thumbnail and msg_id not in st.session_state.show_original_images:
+                    st.image(thumbnail)
+                    if st.button("View original", key=f"original-btn-{msg_id}"):
+                        st.session_state.show_original_images.add(msg_id)
+                        st.rerun()
+                else:
+                    st.image(resolve_file_path(file_path))
             elif msg_type == "file" and file_path:
-                with open(file_path, "rb") as f:
-                    st.download_button("Download File", data=f.read(), file_name=os.path.basename(file_path))
+                # Rendered from stored metadata; the file is only read when someone clicks download
+                st.markdown(f"📎 **{file_name}** · {format_file_size(file_size)} · {mime_type}")
+                st.download_button(
+                    "Download File",
+                    data=functools.partial(read_upload, file_path),
+                    file_name=file_name,
+                    mime=mime_type,
+                    on_click="ignore",
+                    key=f"download-{msg_id}",
+                )
             elif msg_type == "voice" and file_path:
-                st.audio(file_path)
+                st.audio(resolve_file_path(file_path), format=mime_type or "audio/wav")
 
             # Edit button for user's last message and text only
-            if user == st.session_state.username and msg_id == last_user_msg_id and msg_type == "text":
+            if (user == st.session_state.username and msg_id == last_user_msg_id and msg_type == "text"
+                    and not is_archived):
                 if st.button("Edit", key=f"edit-btn-{msg_id}"):
                     st.session_state.edit_message_id = msg_id
                     st.session_state.edit_message_content = content
@@ -451,14 +597,15 @@ for (
             st.rerun()
 
         # Like/unlike feature
-        liked_users = get_likes_for_message(msg_id)
-        current_user_liked = st.session_state.username in liked_users
+        current_user_liked = st.session_state.username in display["liked_users"]
 
         like_label = "Unlike ❤️" if current_user_liked else "Like 🤍"
         col_like, col_users = st.columns([1, 5])
 
         with col_like:
-            if st.button(like_label, key=f"like-btn-{msg_id}"):
+            if is_archived:
+                st.caption("🗄️ Archived (read-only)")
+            elif st.button(like_label, key=f"like-btn-{msg_id}"):
                 if current_user_liked:
                     remove_like(st.session_state.username, msg_id)
                 else:
@@ -466,23 +613,18 @@ for (
                 st.rerun()
 
         with col_users:
-            if liked_users:
-                max_show = 5
-                shown_users = list(liked_users)[:max_show]
-                display_names = ", ".join(shown_users)
-                if len(liked_users) > max_show:
-                    display_names += f", and {len(liked_users) - max_show} more"
-                st.markdown(f"<small>Liked by: {display_names}</small>", unsafe_allow_html=True)
-            else:
-                st.markdown("<small>No likes yet</small>", unsafe_allow_html=True)
+            st.markdown(display["likes"], unsafe_allow_html=True)
 
 st.divider()
+rerun_trace.phase("composer")
 
 # Reply preview above input
 if st.session_state.get("reply_to"):
-    replied_msg = get_message_by_id(st.session_state.reply_to)
+    replied_msg = get_reply_preview(
+        st.session_state.reply_to, conversation_key(st.session_state.username, active_chat_user)
+    )
     if replied_msg:
-        r_id, r_user, r_ts, r_type, r_content, r_file_path, r_recipient, r_reply_to = replied_msg
+        r_user, r_type, r_content = replied_msg
         preview_text = r_content if r_type == "text" else f"[{r_type.capitalize()} message]"
         st.markdown(f"**Replying to {r_user}:** {preview_text}")
     else:
@@ -495,15 +637,7 @@ st.subheader("Send a Message")
 msg_type = st.selectbox("Message Type", ["text", "image", "file", "voice"], key="msg_type")
 
 def jump_to_latest_page():
-    _, total_count = get_messages(
-        st.session_state.username,
-        active_chat_user,
-        search_text=st.session_state.search_text.strip() or None,
-        page=1,
-        page_size=1,
-    )
-    last_page = max(1, (total_count + st.session_state.page_size - 1) // st.session_state.page_size)
-    st.session_state.page = last_page
+    st.session_state.page_cursor = None
 
 reply_to = st.session_state.get("reply_to", None)
 
@@ -527,7 +661,8 @@ elif msg_type == "image":
         save_message(
             st.session_state.username,
             "image",
-            file_bytes=uploaded.read(),
+            file_obj=uploaded,
+            mime_type=uploaded.type,
             file_name=uploaded.name,
             recipient=active_chat_user,
             reply_to=reply_to,
@@ -542,7 +677,8 @@ elif msg_type == "file":
         save_message(
             st.session_state.username,
             "file",
-            file_bytes=uploaded.read(),
+            file_obj=uploaded,
+            mime_type=uploaded.type,
             file_name=uploaded.name,
             recipient=active_chat_user,
             reply_to=reply_to,
@@ -560,7 +696,8 @@ elif msg_type == "voice":
         save_message(
             st.session_state.username,
             "voice",
-            file_bytes=uploaded.read(),
+            file_obj=uploaded,
+            mime_type=uploaded.type,
             file_name=uploaded.name,
             recipient=active_chat_user,
             reply_to=reply_to,
@@ -568,3 +705,35 @@ elif msg_type == "voice":
         st.session_state.reply_to = None
         jump_to_latest_page()
         st.rerun()
+
+# Performance panel for admins: this rerun so far, and totals for this server process
+if st.session_state.username in METRICS_ADMINS:
+    rerun_trace.phase("admin_panel")
+    with st.sidebar.expander("⏱ Performance"):
+        elapsed_ms = (time.perf_counter() - rerun_trace.started) * 1000
+        st.markdown(f"**This rerun:** {elapsed_ms:.1f} ms · {rerun_trace.queries} queries · {rerun_trace.rows} rows")
+        st.dataframe(
+            [{"phase": name, "ms": round(seconds * 1000, 2)} for name, seconds in rerun_trace.phases.items()],
+            hide_index=True,
+        )
+        st.dataframe(
+            [
+                {"function": name, "calls": calls, "ms": round(seconds * 1000, 2), "queries": queries, "rows": rows}
+                for name, (calls, seconds, queries, rows) in rerun_trace.calls.items()
+            ],
+            hide_index=True,
+        )
+        st.markdown("**Process totals**")
+        st.dataframe(
+            [{"function": name, **{k: round(v, 2) for k, v in stats.items()}} for name, stats in get_metrics().summary().items()],
+            hide_index=True,
+        )
+        st.download_button(
+            "Download Prometheus metrics",
+            data=get_metrics().prometheus_text,
+            file_name="privatechat_metrics.prom",
+            mime="text/plain",
+            on_click="ignore",
+        )
+
+end_rerun_trace(rerun_trace)
@@ -0,0 +1,223 @@
+import hashlib
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import chat_transfer
+import chatstore
+
+# Tests for the data layer in chatstore.py (and the importer built on it). Run with: python -m pytest
+
+# --- FIXTURES ---
+# Each call switches the data layer to a fresh data directory. Connection pools and the writer thread
+# are created per database path, so every store gets its own; init_db otherwise runs once per process.
+@pytest.fixture
+def use_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(chatstore, "NOTIFY_FOLDER", None)
+
+    def use(name="store"):
+        path = tmp_path / name
+        path.mkdir(exist_ok=True)
+        monkeypatch.chdir(path)
+        monkeypatch.setattr(chatstore, "DB_NAME", str(path / "chat.db"))
+        chatstore.init_db.__wrapped__()
+        return path
+
+    return use
+
+def save(username, content, recipient=None, reply_to=None):
+    return chatstore.save_message(username, "text", content=content, recipient=recipient, reply_to=reply_to)
+
+# Moves messages back in time, keeping their order, so archive_old_messages picks them up
+def backdate(message_ids, days):
+    ts = int(time.time() * 1000) - days * 86400 * 1000
+
+    def write(conn):
+        for i, message_id in enumerate(message_ids):
+            conn.execute("UPDATE messages SET ts = ? WHERE id = ?", (ts + i, message_id))
+
+    chatstore.run_write(write)
+
+# --- MIGRATIONS ---
+# The schema privatechat.py created before the data layer existed (user_version 0)
+BASELINE_SCHEMA = [
+    """
+    CREATE TABLE messages (
+        id TEXT PRIMARY KEY,
+        username TEXT NOT NULL,
+        recipient TEXT,
+        timestamp TEXT NOT NULL,
+        type TEXT NOT NULL,
+        content TEXT,
+        file_path TEXT,
+        reply_to TEXT
+    )
+    """,
+    "CREATE TABLE users_online (username TEXT PRIMARY KEY, last_seen TEXT NOT NULL)",
+    "CREATE TABLE user_pins (username TEXT PRIMARY KEY, pin_hash TEXT NOT NULL)",
+    """
+    CREATE TABLE message_likes (
+        message_id TEXT NOT NULL,
+        username TEXT NOT NULL,
+        PRIMARY KEY (message_id, username),
+        FOREIGN KEY (message_id) REFERENCES messages(id),
+        FOREIGN KEY (username) REFERENCES user_pins(username)
+    )
+    """,
+]
+
+def test_baseline_database_is_upgraded_in_place(use_store, tmp_path):
+    (tmp_path / "store").mkdir()
+    conn = sqlite3.connect(tmp_path / "store" / "chat.db")
+    for statement in BASELINE_SCHEMA:
+        conn.execute(statement)
+    legacy_hash = hashlib.sha256(b"1234").hexdigest()
+    conn.executemany("INSERT INTO user_pins VALUES (?, ?)", [("alice", legacy_hash), ("bob", legacy_hash)])
+    start = datetime.now(timezone.utc) - timedelta(hours=1)
+    rows = [
+        ("m1", "alice", None, "hello everyone", None),
+        ("m2", "bob", None, "hello alice", "m1"),
+        ("m3", "alice", "bob", "private hello", None),
+        ("m4", "bob", "alice", "private reply", "m3"),
+        ("m5", "bob", None, "bye", None),
+    ]
+    conn.executemany(
+        "INSERT INTO messages (id, username, recipient, timestamp, type, content, reply_to) VALUES (?, ?, ?, ?, 'text', ?, ?)",
+        [
+            (message_id, username, recipient, (start + timedelta(minutes=i)).isoformat(), content, reply_to)
+            for i, (message_id, username, recipient, content, reply_to) in enumerate(rows)
+        ],
+    )
+    conn.execute("INSERT INTO message_likes VALUES ('m1', 'bob')")
+    conn.commit()
+    conn.close()
+
+    use_store()
+
+    with chatstore.get_db() as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(chatstore.MIGRATIONS)
+    messages, total, has_older, has_newer = chatstore.get_messages("alice")
+    assert [m[0] for m in messages] == ["m1", "m2", "m5"]
+    assert (total, has_older, has_newer) == (3, False, False)
+    assert messages[0][8] == 1  # like_count
+    assert messages[1][-1] == ("alice", "text", "hello everyone")  # reply preview
+    messages, total, _, _ = chatstore.get_messages("bob", "alice")
+    assert [m[0] for m in messages] == ["m3", "m4"] and total == 2
+    # Existing users start with everything read
+    assert all(unread == 0 for _, unread in chatstore.get_unread_counts("alice").values())
+    assert {m[0] for m in chatstore.search_messages("alice", None, "hello")[0]} == {"m1", "m2"}
+    # Legacy PIN hashes still log in and are upgraded on the way
+    assert chatstore.verify_pin("alice", "1234")
+    assert chatstore.get_user_pin_hash("alice").startswith(chatstore.PIN_HASH_SCHEME + "$")
+
+# --- PAGING AND ARCHIVES ---
+def test_pages_continue_from_hot_table_into_archives(use_store):
+    use_store()
+    ids = [save("alice", f"message {i}") for i in range(25)]
+    backdate(ids[:8], 400)
+    backdate(ids[8:15], 300)
+    assert chatstore.archive_old_messages() == 15
+    assert chatstore.get_archived_message_ids(ids) == set(ids[:15])
+
+    messages, total, has_older, has_newer = chatstore.get_messages("alice", page_size=10)
+    assert total == 25 and not has_newer
+    seen = [m[0] for m in messages]
+    while has_older:
+        messages, _, has_older, has_newer = chatstore.get_messages("alice", before=messages[0][0], page_size=10)
+        assert has_newer
+        seen = [m[0] for m in messages] + seen
+    assert seen == ids
+
+    messages, _, has_older, has_newer = chatstore.get_messages("alice", after=ids[4], page_size=10)
+    assert [m[0] for m in messages] == ids[5:15]
+    assert has_older and has_newer
+
+def test_archived_messages_are_read_only(use_store):
+    use_store()
+    message_id = save("alice", "old news")
+    backdate([message_id], 400)
+    chatstore.archive_old_messages()
+    seq = chatstore.get_change_seq()
+    chatstore.add_like("bob", message_id)
+    chatstore.update_message_content(message_id, "rewritten")
+    assert chatstore.get_change_seq() == seq
+    messages = chatstore.get_messages("alice")[0]
+    assert [(m[4], m[8]) for m in messages] == [("old news", 0)]
+
+# --- SEARCH ---
+def test_search_only_matches_the_searched_conversation(use_store):
+    use_store()
+    global_id = save("alice", "quarterly budget")
+    private_id = save("alice", "budget draft", recipient="bob")
+    save("carol", "budget secrets", recipient="dave")
+    archived_id = save("alice", "Ǘber budget from last year")
+    backdate([archived_id], 400)
+    assert chatstore.archive_old_messages() == 1
+
+    def found(user, chat_with=None, text="budg"):
+        messages, total, _ = chatstore.search_messages(user, chat_with, text)
+        assert total == len(messages)
+        return {m[0] for m in messages}
+
+    assert found("alice") == {global_id, archived_id}
+    assert found("bob", "alice") == {private_id}
+    assert found("alice", "dave") == set()
+    assert found("carol", "dave") != set()
+    # Archives fold diacritics the way the hot index does
+    assert found("alice", text="uber") == {archived_id}
+
+# --- SESSIONS ---
+def test_session_tokens_are_rejected_when_forged_expired_or_revoked(use_store, monkeypatch):
+    use_store()
+    token = chatstore.create_session("alice")
+    assert chatstore.resume_session(token) == "alice"
+
+    token_id, expires, signature = token.split(".")
+    expired_ms = int(time.time() * 1000) - 1
+    for bad in (
+        f"{token_id}.{int(expires) + 1}.{signature}",  # extended expiry
+        f"{token_id}.{expires}.{'0' * len(signature)}",
+        f"{token_id}.{expired_ms}.{chatstore.sign_session(token_id, expired_ms)}",
+        f"{token_id}.{expires}",
+        "café.1.2",
+        None,
+    ):
+        assert chatstore.resume_session(bad) is None
+
+    other = chatstore.create_session("bob")
+    chatstore.end_session(other)
+    assert chatstore.resume_session(other) is None
+
+    # A logout in another process only reaches this one's cache when it rechecks SQLite
+    monkeypatch.setattr(chatstore, "SESSION_RECHECK_SECONDS", 0)
+    chatstore.run_write(lambda conn: conn.execute("DELETE FROM session_tokens"))
+    assert chatstore.resume_session(token) is None
+
+# --- IMPORT ---
+def test_import_is_idempotent_and_feeds_the_change_log(use_store, tmp_path):
+    use_store("source")
+    first = save("alice", "hello")
+    save("bob", "hi alice", reply_to=first)
+    save("alice", "private note", recipient="bob")
+    chatstore.add_like("bob", first)
+    export_dir = str(tmp_path / "export")
+    chat_transfer.export_history(export_dir, None, 0, chat_transfer.END_OF_TIME_MS)
+
+    use_store("target")
+    stats = chat_transfer.import_history(export_dir)
+    assert (stats["messages"], stats["messages_skipped"], stats["likes"]) == (3, 0, 1)
+    seq = chatstore.get_change_seq()
+    assert sorted(kind for _, _, kind in chatstore.get_changes_since(0, "global")) == ["insert", "insert", "like"]
+
+    assert chat_transfer.import_history(export_dir)["messages"] == 0  # resumes past the end
+    again = chat_transfer.import_history(export_dir, restart=True)
+    assert (again["messages"], again["messages_skipped"], again["likes"]) == (0, 3, 0)
+    assert chatstore.get_change_seq() == seq
+
+    messages, total, _, _ = chatstore.get_messages("alice")
+    assert total == 2 and [m[4] for m in messages] == ["hello", "hi alice"] and messages[0][8] == 1
+    assert chatstore.get_unread_counts("carol")["global"] == (None, 2)
+    private = chatstore.get_messages("alice", "bob")[0]
+    assert [m[0] for m in chatstore.search_messages("bob", "alice", "note")[0]] == [private[0][0]]
@@ -0,0 +1,34 @@
+import os
+
+# Runs in worker processes, so it lives in its own importable module and imports Pillow lazily.
+# Pillow is optional: without it no thumbnails are written and the chat shows originals.
+
+def thumbnail_path(source_path, size):
+    return f"{source_path}.thumb{size}.jpg"
+
+def make_thumbnails(source_path, sizes):
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return []
+    written = []
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode in ("RGBA", "LA", "P"):
+            # JPEG has no alpha channel: flatten transparent images onto white
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        for size in sizes:
+            dest = thumbnail_path(source_path, size)
+            if not os.path.exists(dest):
+                thumb = image.copy()
+                thumb.thumbnail((size, size))
+                tmp = f"{dest}.{os.getpid()}.tmp"
+                thumb.save(tmp, "JPEG", quality=80, optimize=True)
+                os.replace(tmp, dest)
+            written.append(dest)
+    return written